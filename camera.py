@@ -1,43 +1,262 @@
+import collections
 from fractions import Fraction
+import io
 import logging
+import math
+import os.path
+import threading
 import time
 
 import cv2
-from PyQt5 import QtGui
+import numpy as np
+
+from framebus import FrameBus
 
 try:
-    from picamera import PiCamera
-    from picamera.array import PiRGBArray
+    from picamera import PiCamera, PiCameraCircularIO
+    from picamera.array import raw_resolution
     REAL_CAMERA = True
 except ModuleNotFoundError:
     from virtualcamera import FakePicamera as PiCamera
-    from virtualcamera import FakePiRGBArray as PiRGBArray
+    from virtualcamera import FakeCircularIO as PiCameraCircularIO
+    from virtualcamera import raw_resolution
     REAL_CAMERA = False
 
 
+PREVIEW_RING_SIZE = 3
+# Splitter ports of the video port used by video recordings, the MJPEG
+# stream and captures (bursts, stacks and brackets). 0 is used by the
+# preview, which keeps running during captures, e.g. for motion detection.
+RECORDING_SPLITTER_PORT = 1
+MJPEG_SPLITTER_PORT = 2
+CAPTURE_SPLITTER_PORT = 3
+RECORDING_BITRATE = 17000000
+
+# Exposure brackets, in stops from the metered exposure
+BRACKET_STOPS = [-2, 0, 2]
+MIN_SHUTTER_SPEED = 100
+MAX_SHUTTER_SPEED = 6000000  # the longest of the V1 module
+MAX_ISO = 800
+# Time for the gains to settle on a new ISO before they are locked
+ISO_SETTLE_TIME = 0.5
+# Frames the sensor may take to apply a new shutter speed
+SHUTTER_SETTLE_FRAMES = 3
+
+# gain is the total (analog times digital) gain the step is taken at
+BracketStep = collections.namedtuple("BracketStep",
+                                     ["ev", "shutter_speed", "gain"])
+
+# Images can be read reduced by 2, 4 or 8, which JPEG decoding does much
+# faster than a full decode
+_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
 class Image:
-    def __init__(self, cv2_img):
+    def __init__(self, cv2_img, color_order: str = "bgr"):
         self._image = cv2_img
+        self._color_order = color_order
+
+    @property
+    def array(self):
+        return self._image
+
+    @property
+    def color_order(self) -> str:
+        return self._color_order
+
+    def read_only(self):
+        # Same pixels, for sharing between consumers that must not modify
+        # them
+        array = self._image.view()
+        array.flags.writeable = False
+        return Image(array, self._color_order)
+
+    def as_qtimage(self) -> "QtGui.QImage":
+        # Imported here so the camera can be used without Qt (server.py)
+        from PyQt5 import QtGui
 
-    def as_qtimage(self) -> QtGui.QImage:
-        rgb_image = cv2.cvtColor(self._image, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_image.shape
+        image = self._image
+        if self._color_order == "rgb":
+            image_format = QtGui.QImage.Format_RGB888
+        elif hasattr(QtGui.QImage, "Format_BGR888"):  # Qt >= 5.14
+            image_format = QtGui.QImage.Format_BGR888
+        else:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            image_format = QtGui.QImage.Format_RGB888
+        h, w = image.shape[:2]
 
-        bytes_per_line = ch * w
-        return QtGui.QImage(rgb_image.data, w, h, bytes_per_line,
-                            QtGui.QImage.Format_RGB888)
+        # The array may be a cropped view of a padded buffer, so use its
+        # real row stride instead of assuming the rows are contiguous.
+        bytes_per_line = image.strides[0]
+        return QtGui.QImage(image.ctypes.data, w, h, bytes_per_line,
+                            image_format)
     @staticmethod
-    def from_file(filename):
-        cv2_img = cv2.imread(filename)
+    def from_file(filename, reduce: int = 1):
+        cv2_img = cv2.imread(filename, _READ_FLAGS[reduce])
         return Image(cv2_img)
 
+    @staticmethod
+    def from_bytes(data, reduce: int = 1):
+        cv2_img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                               _READ_FLAGS[reduce])
+        return Image(cv2_img)
+
+
+# Output for capture_continuous that writes each frame into the next buffer
+# of a preallocated ring, so a frame stays valid until the ring wraps around
+# and no memory is allocated per frame.
+class FrameRing:
+    # Buffers the preview frames are written to in turn. A consumer may hold
+    # the buffer of a frame (see hold and release), which is then skipped
+    # until released, so the frame is not overwritten under it.
+    def __init__(self, resolution, size: int = PREVIEW_RING_SIZE):
+        width, height = resolution
+        self._size = (width, height)
+        self._buffers = []
+        self._frames = []
+        self._holds = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._add_buffer()
+        self._index = 0
+        self._offset = 0
+
+    def _add_buffer(self):
+        width, height = self._size
+        raw_width, raw_height = raw_resolution(self._size)
+        buffer = np.empty((raw_height, raw_width, 3), dtype=np.uint8)
+        self._buffers.append(buffer)
+        self._frames.append(buffer[:height, :width])
+        self._holds.append(0)
+
+    @property
+    def array(self):
+        return self._frames[self._index]
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    def hold(self, index: int):
+        with self._lock:
+            self._holds[index] += 1
+
+    def release(self, index: int):
+        with self._lock:
+            self._holds[index] -= 1
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        end = self._offset + len(data)
+        memoryview(self._buffers[self._index]).cast("B")[self._offset:end] = data
+        self._offset = end
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def rewind(self):
+        # The next frame is written over the current one
+        self._offset = 0
+
+    def truncate(self, size=None):
+        # Called once the consumer is done with the frame: move on to the
+        # next buffer of the ring that nobody holds. The frame just written
+        # is never reused right away, it is only held once handed out. If
+        # all the others are held the ring grows, the camera never waits for
+        # a consumer.
+        with self._lock:
+            count = len(self._buffers)
+            for step in range(1, count):
+                index = (self._index + step) % count
+                if not self._holds[index]:
+                    break
+            else:
+                logging.getLogger(__name__).debug(
+                    "All %d other preview buffers are held, adding one",
+                    count - 1)
+                self._add_buffer()
+                index = count
+            self._index = index
+            self._offset = 0
+
+
+# Output of a triggered pre-recording. The encoder switches to it at the
+# next key frame, before the buffered seconds have been copied to the file,
+# so what it writes meanwhile is held until release.
+class _TriggeredOutput:
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, "wb")
+        self._lock = threading.Lock()
+        self._held = []
+
+    def write(self, data):
+        with self._lock:
+            if self._held is None:
+                return self.file.write(data)
+            self._held.append(bytes(data))
+            return len(data)
+
+    def flush(self):
+        with self._lock:
+            self.file.flush()
+
+    def release(self):
+        with self._lock:
+            for data in self._held:
+                self.file.write(data)
+            self._held = None
+
+    def close(self):
+        self.file.close()
+
+
+# Longest wait between two batches of settings, however slow the framerate
+MAX_SETTINGS_INTERVAL = 1.0
+
+# Order in which pending settings are written. The framerate bounds the
+# longest shutter speed, so it goes before it.
+SETTINGS_ORDER = ["framerate", "iso", "exposure_mode", "shutter_speed",
+                  "awb_mode", "awb_gains", "brightness", "contrast", "led"]
+
+
+def parse_shutter_speed(value: str) -> int:
+    # "1/250" or "0.5" (seconds) to microseconds
+    if "/" in value:
+        denom = int(value.split("/")[1])
+        return int(1000000 / denom)
+    return int(float(value) * 1000000)
+
 
 class Camera:
     def __init__(self, resolution=None, framerate=None):
         self._camera = None
-        self._raw_capture = None
         self._resolution = resolution
         self._framerate = framerate
+        self._unlocked_settings = None
+
+        # Settings are not written when set but batched, see apply_settings
+        self._pending = {}
+        self._applied = {}
+        self._last_applied = 0
+        self._settings_changed = threading.Condition()
+        self._apply_lock = threading.Lock()
+        self._settings_thread = None
+        self._settings_running = False
+
+        # Preview frames for any number of consumers, see preview
+        self.frames = FrameBus(self)
+
+        self._recording = False
+        self._prerecord = None
+        self._recording_output = None
+        self._mjpeg = False
 
     def open(self):
         framerate = self._framerate
@@ -46,15 +265,29 @@ class Camera:
         self._camera = PiCamera(resolution=self._resolution,
                                 framerate=framerate,
                                 sensor_mode=0)
-        self._raw_capture = PiRGBArray(self._camera)
         self.shutter_speed = 0  # auto
 
+        self._settings_running = True
+        self._settings_thread = threading.Thread(
+            target=self._run_settings, name="CameraSettings", daemon=True)
+        self._settings_thread.start()
+
         time.sleep(0.1)  # warm up
 
     def close(self):
+        self.frames.stop()
+        if self._recording:
+            self.stop_recording()
+        with self._settings_changed:
+            self._settings_running = False
+            self._settings_changed.notify()
+        self._settings_thread.join()
+        self._settings_thread = None
+        self._pending = {}
+        self._applied = {}
+
         self._camera.close()
         self._camera = None
-        self._raw_capture = None
 
     def __enter__(self):
         self.open()
@@ -63,70 +296,432 @@ class Camera:
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.close()
 
+    def _set(self, name, value):
+        with self._settings_changed:
+            self._pending[name] = value
+            self._settings_changed.notify()
+
+    def _current(self, name):
+        # Value the setting will have once the pending ones are applied
+        with self._settings_changed:
+            if name in self._pending:
+                return self._pending[name]
+        if name in self._applied:
+            return self._applied[name]
+        return getattr(self._camera, name)
+
+    def apply_settings(self):
+        # Writes the pending settings now, skipping the ones that already
+        # have that value. A setting the camera refuses is logged and
+        # dropped, the others are still written.
+        logger = logging.getLogger(__name__)
+        with self._apply_lock:
+            with self._settings_changed:
+                pending, self._pending = self._pending, {}
+            for name in SETTINGS_ORDER:
+                if name not in pending or self._applied.get(name) == pending[name]:
+                    continue
+                logger.debug("Set %s value to %s", name, pending[name])
+                try:
+                    setattr(self._camera, name, pending[name])
+                except Exception:
+                    logger.exception("Could not set %s to %s", name,
+                                     pending[name])
+                    continue
+                self._applied[name] = pending[name]
+            self._last_applied = time.monotonic()
+
+    def _run_settings(self):
+        # Applies the settings off the caller's thread, at most once per
+        # frame: changes made in between (e.g. dragging a slider) are
+        # coalesced into a single write
+        while True:
+            with self._settings_changed:
+                while self._settings_running and not self._pending:
+                    self._settings_changed.wait()
+                if not self._settings_running:
+                    return
+
+            try:
+                delay = (self._last_applied + self._frame_interval()
+                         - time.monotonic())
+                if delay > 0:
+                    time.sleep(delay)
+                self.apply_settings()
+            except Exception:
+                logging.getLogger(__name__).exception("Could not apply the"
+                                                      " camera settings")
+
+    def _frame_interval(self) -> float:
+        # Seconds per frame, for pacing. An invalid framerate must not stop
+        # the settings thread, it is rejected when applied.
+        try:
+            framerate = float(self._current("framerate"))
+        except (TypeError, ValueError):
+            framerate = 0
+        if framerate <= 0:
+            return 0
+        return min(1 / framerate, MAX_SETTINGS_INTERVAL)
+
     def set_awb_gain(self, gain: float):
-        self._camera.awb_gains = gain
+        self._set("awb_gains", gain)
 
     def set_awb_mode(self, mode: str):
-        self._camera.awb_mode = mode
+        self._set("awb_mode", mode)
 
     def set_iso(self, value: int):
-        logging.getLogger(__name__).debug("Set iso value to %d", value)
-        self._camera.iso = value
+        self._set("iso", value)
     
     def set_brightness(self, value: int):
-        logging.getLogger(__name__).debug("Set brightness value to %d", value)
-        self._camera.brightness = value
+        self._set("brightness", value)
 
     def set_contrast(self, value: int):
-        logging.getLogger(__name__).debug("Set contrast value to %d", value)
-        self._camera.contrast = value
+        self._set("contrast", value)
 
     def set_exposure(self, value):
-        self._camera.exposure_mode = value
+        self._set("exposure_mode", value)
     
     def maximize_fps(self):
         current_shutter_speed = self.get_exposure_speed()
-        max_fps = Fraction(current_shutter_speed, 1000000)
+        if not current_shutter_speed:
+            logging.getLogger(__name__).warning("No exposure speed to compute"
+                                                " the maximum framerate")
+            return
+        max_fps = Fraction(1000000, current_shutter_speed)
         logging.getLogger(__name__).debug("Having exposure speed of %f, the"
                                           " maximum framerate is %s",
                                           current_shutter_speed, max_fps)
-        self._camera.framerate = max_fps
+        self._set("framerate", max_fps)
 
     def set_shutter_speed(self, value: str):
-        if "/" in value:
-            denom = int(value.split("/")[1])
-            microseconds = int(1000000 / denom)
-        else:
-            seconds = float(value)
-            microseconds = int(seconds * 1000000)
+        microseconds = parse_shutter_speed(value)
 
-        if 1000000 / self._camera.framerate < microseconds:
+        if 1000000 / self._current("framerate") < microseconds:
             logging.getLogger(__name__).warning("Framerate is too fast for this shutter speed")
             if self._framerate is None:
                 new_framerate = Fraction(1000000/microseconds)
                 logging.getLogger(__name__).info("Changing the framerate to be %s", new_framerate)
-                self._camera.framerate = new_framerate
+                self._set("framerate", new_framerate)
+
+        self._set("shutter_speed", microseconds)
 
-        logging.getLogger(__name__).debug("Set shutter speed value to %s (%d)",
-                                          value, microseconds)
-        self._camera.shutter_speed = microseconds
+    def set_settings(self, settings: dict):
+        # Queues several settings (e.g. a preset) as a single batch for the
+        # settings thread: they are written in SETTINGS_ORDER and unchanged
+        # ones are skipped, which keeps sensor reconfigurations to a minimum.
+        # Nothing is queued if any name is invalid.
+        invalid = [name for name in settings if name not in SETTINGS_ORDER]
+        if invalid:
+            raise ValueError(f"Invalid setting {', '.join(invalid)}")
+        with self._settings_changed:
+            for name, value in settings.items():
+                if name == "awb_gains" and isinstance(value, list):
+                    value = tuple(value)
+                self._pending[name] = value
+            self._settings_changed.notify()
+
+    def get_current_settings(self, names) -> dict:
+        # Values as set, in a form that can be saved to JSON
+        settings = {}
+        for name in names:
+            value = self._current(name)
+            if isinstance(value, Fraction):
+                value = float(value)
+            elif isinstance(value, tuple):
+                value = [float(v) for v in value]
+            settings[name] = value
+        return settings
+
+    def lock_exposure(self):
+        # Freeze the current automatic exposure and white balance, so all the
+        # pictures of a sequence match
+        self.apply_settings()
+        self._unlocked_settings = (self._current("shutter_speed"),
+                                   self._current("exposure_mode"),
+                                   self._current("awb_mode"))
+        gains = self._camera.awb_gains
+        self._set("shutter_speed", self._camera.exposure_speed)
+        self._set("exposure_mode", "off")
+        self._set("awb_mode", "off")
+        self._set("awb_gains", gains)
+        self.apply_settings()
+        logging.getLogger(__name__).debug("Locked exposure at %d and AWB"
+                                          " gains at %s",
+                                          self._camera.shutter_speed, gains)
+
+    def unlock_exposure(self):
+        if self._unlocked_settings is None:
+            return
+        shutter_speed, exposure_mode, awb_mode = self._unlocked_settings
+        self._set("shutter_speed", shutter_speed)
+        self._set("exposure_mode", exposure_mode)
+        self._set("awb_mode", awb_mode)
+        self._unlocked_settings = None
 
     def set_led(self, value: bool):
-        logging.getLogger(__name__).debug("Set led value to %s", value)
-        self._camera.led = value
+        self._set("led", value)
 
     def get_exposure_speed(self):
         return self._camera.exposure_speed
 
-    def take_picture(self, filename: str):
+    def get_settings(self) -> dict:
+        # Current values of the settings, as stored in the catalog
+        awb_red, awb_blue = self._camera.awb_gains
+        return {
+            "iso": self._camera.iso,
+            "shutter_speed": self._camera.shutter_speed,
+            "exposure_speed": self._camera.exposure_speed,
+            "exposure_mode": self._camera.exposure_mode,
+            "awb_mode": self._camera.awb_mode,
+            "awb_red": float(awb_red),
+            "awb_blue": float(awb_blue),
+            "brightness": self._camera.brightness,
+            "contrast": self._camera.contrast,
+            "framerate": float(self._camera.framerate),
+        }
+
+    def get_resolution(self):
+        return tuple(self._camera.resolution)
+
+    def capture_to_memory(self, image_format: str):
+        # Returns the encoded picture, the camera is free for the next one
+        # as soon as this returns
         logging.getLogger(__name__).debug("Take new picture")
-        self._camera.capture(filename)
-
-    def preview(self):
-        for frame in self._camera.capture_continuous(self._raw_capture,
-                                                     format="bgr",
-                                                     use_video_port=True):
-            image = Image(frame.array)
-            # clear the stream for the next frame
-            self._raw_capture.truncate(0)
-            yield image
+        self.apply_settings()
+        stream = io.BytesIO()
+        self._camera.capture(stream, format=image_format)
+        return stream
+
+    def _preview_resize(self, resolution):
+        if resolution is None:
+            return None
+        width, height = resolution
+        camera_width, camera_height = self._camera.resolution
+        if width >= camera_width and height >= camera_height:
+            return None  # never upscale the preview
+        return (min(width, camera_width), min(height, camera_height))
+
+    def capture_burst(self, filenames, on_captured):
+        # Frames are encoded to memory from the video port, which keeps
+        # running between them. on_captured(filename, stream) is called as
+        # soon as each frame is encoded, writing it is up to the caller.
+        logging.getLogger(__name__).debug("Take burst of %d pictures",
+                                          len(filenames))
+        image_format = os.path.splitext(filenames[0])[1][1:]
+        self.apply_settings()
+
+        def outputs():
+            for filename in filenames:
+                stream = io.BytesIO()
+                yield stream
+                # Asking for the next output means this one is complete
+                on_captured(filename, stream)
+
+        self._camera.capture_sequence(outputs(), format=image_format,
+                                      use_video_port=True,
+                                      splitter_port=CAPTURE_SPLITTER_PORT)
+
+    def capture_frames(self, count: int, on_frame):
+        # count frames back to back from the video port, unencoded so no
+        # compression artifacts are added. on_frame(array) is called with
+        # each BGR frame as soon as it is complete; the array is a single
+        # buffer overwritten by the next frame.
+        logging.getLogger(__name__).debug("Capture %d frames", count)
+        self.apply_settings()
+        output = FrameRing(self._camera.resolution, 1)
+
+        def outputs():
+            for _ in range(count):
+                yield output
+                on_frame(output.array)
+                output.rewind()
+
+        self._camera.capture_sequence(outputs(), format="bgr",
+                                      use_video_port=True,
+                                      splitter_port=CAPTURE_SPLITTER_PORT)
+
+    def _gain(self) -> float:
+        return float(self._camera.analog_gain * self._camera.digital_gain)
+
+    @staticmethod
+    def plan_bracket(stops, exposure: float, gain: float,
+                     max_shutter_speed: int = MAX_SHUTTER_SPEED):
+        # Shutter speed of each step for a total exposure (shutter speed
+        # times gain) of exposure * 2 ** ev, at a fixed gain
+        plan = []
+        for ev in stops:
+            shutter_speed = round(exposure * 2 ** ev / gain)
+            clamped = min(max(shutter_speed, MIN_SHUTTER_SPEED),
+                          max_shutter_speed)
+            if clamped != shutter_speed:
+                logging.getLogger(__name__).warning(
+                    "Bracket step %+g EV limited to %d us", ev, clamped)
+            plan.append(BracketStep(ev, clamped, gain))
+        return plan
+
+    def capture_bracket(self, stops, image_format: str, on_captured):
+        # Captures a frame per exposure of stops (in EV from the metered one)
+        # back to back from the video port, and returns the plan they were
+        # taken with. on_captured(step, stream) is called as soon as each
+        # frame is encoded, with the camera still at that step's settings.
+        #
+        # The plan is built from the locked exposure: the gains can not
+        # change per step once locked, so they are only raised (through the
+        # ISO, before locking again) when the longest step would not fit in
+        # the longest shutter speed. That is MAX_SHUTTER_SPEED, with the
+        # framerate set once low enough for the longest step, or the current
+        # frame interval while an encoder runs, since the framerate can not
+        # change then.
+        self.apply_settings()
+        framerate = self._current("framerate")
+        iso = self._current("iso")
+        encoding = self.is_encoding()
+        if encoding:
+            max_shutter_speed = min(int(1000000 / framerate),
+                                    MAX_SHUTTER_SPEED)
+        else:
+            max_shutter_speed = MAX_SHUTTER_SPEED
+        self.lock_exposure()
+        try:
+            gain = self._gain()
+            exposure = self._camera.exposure_speed * gain
+            needed = exposure * 2 ** max(stops) / max_shutter_speed
+            if needed > gain and gain < MAX_ISO / 100:
+                # ISO 100 is about unit gain
+                self.unlock_exposure()
+                self._set("iso", min(math.ceil(needed * 100), MAX_ISO))
+                self.apply_settings()
+                time.sleep(ISO_SETTLE_TIME)
+                self.lock_exposure()
+                gain = self._gain()
+            plan = self.plan_bracket(stops, exposure, gain, max_shutter_speed)
+            logging.getLogger(__name__).debug("Capture bracket %s", plan)
+
+            if not encoding:
+                longest = max(step.shutter_speed for step in plan)
+                self._set("framerate", min(Fraction(framerate),
+                                           Fraction(1000000, longest)))
+                self.apply_settings()
+
+            def outputs():
+                for step in plan:
+                    self._set("shutter_speed", step.shutter_speed)
+                    self.apply_settings()
+                    self._wait_exposure(step.shutter_speed)
+                    stream = io.BytesIO()
+                    yield stream
+                    on_captured(step, stream)
+
+            self._camera.capture_sequence(outputs(), format=image_format,
+                                          use_video_port=True,
+                                          splitter_port=CAPTURE_SPLITTER_PORT)
+        finally:
+            self.unlock_exposure()
+            if not encoding:
+                self._set("framerate", framerate)
+            self._set("iso", iso)
+        return plan
+
+    def _wait_exposure(self, shutter_speed: int):
+        # Until the sensor reports (about) the new shutter speed
+        interval = 1 / float(self._current("framerate"))
+        deadline = time.monotonic() + SHUTTER_SETTLE_FRAMES * interval
+        while (abs(self._camera.exposure_speed - shutter_speed)
+               > shutter_speed / 10 and time.monotonic() < deadline):
+            time.sleep(interval / 4)
+
+    def preview(self, resolution=None, ring_size: int = PREVIEW_RING_SIZE):
+        # Frames are downscaled by the GPU resizer on the video port, so only
+        # display-sized frames are copied and converted. Stills keep being
+        # taken at full resolution on the still port.
+        #
+        # Yields (image, ring, index): the image is overwritten after the
+        # next one is requested, unless its buffer is held with
+        # ring.hold(index) until ring.release(index).
+        #
+        # Only one caller can iterate it at a time, consumers should
+        # subscribe to self.frames instead.
+        self.apply_settings()
+        resize = self._preview_resize(resolution)
+        output = FrameRing(resize or self._camera.resolution, ring_size)
+        for frame in self._camera.capture_continuous(output,
+                                                     format="rgb",
+                                                     use_video_port=True,
+                                                     resize=resize):
+            index = output.index
+            image = Image(frame.array, color_order="rgb")
+            # move to the next free buffer for the next frame
+            output.truncate(0)
+            yield image, output, index
+
+    def start_mjpeg(self, output, resolution=None, quality: int = 0):
+        # The GPU encodes the frames to JPEG on their own splitter port and
+        # writes them to output, from the encoder thread. Preview and
+        # captures keep working meanwhile.
+        self.apply_settings()
+        self._camera.start_recording(output, format="mjpeg",
+                                     splitter_port=MJPEG_SPLITTER_PORT,
+                                     resize=self._preview_resize(resolution),
+                                     quality=quality)
+        self._mjpeg = True
+
+    def stop_mjpeg(self):
+        self._mjpeg = False
+        self._camera.stop_recording(splitter_port=MJPEG_SPLITTER_PORT)
+
+    def is_recording(self) -> bool:
+        return self._recording
+
+    def is_encoding(self) -> bool:
+        # Whether a video encoder runs, which forbids changing the framerate
+        return self._recording or self._mjpeg
+
+    def start_recording(self, filename: str, resolution=None):
+        # Raw H.264 from the GPU encoder on its own splitter port, the
+        # preview keeps running meanwhile
+        logging.getLogger(__name__).debug("Start recording to %s", filename)
+        self.apply_settings()
+        self._camera.start_recording(filename, format="h264",
+                                     splitter_port=RECORDING_SPLITTER_PORT,
+                                     resize=self._preview_resize(resolution),
+                                     bitrate=RECORDING_BITRATE)
+        self._recording = True
+
+    def start_prerecording(self, seconds: float, resolution=None):
+        # Records into memory, keeping only the last seconds until
+        # save_prerecording is called
+        logging.getLogger(__name__).debug("Start pre-recording %d seconds",
+                                          seconds)
+        self.apply_settings()
+        self._prerecord = PiCameraCircularIO(
+            self._camera, seconds=seconds, bitrate=RECORDING_BITRATE,
+            splitter_port=RECORDING_SPLITTER_PORT)
+        self._camera.start_recording(self._prerecord, format="h264",
+                                     splitter_port=RECORDING_SPLITTER_PORT,
+                                     resize=self._preview_resize(resolution),
+                                     bitrate=RECORDING_BITRATE)
+        self._recording = True
+
+    def save_prerecording(self, filename: str):
+        # Writes the buffered seconds to filename and keeps recording into
+        # it until stop_recording
+        if self._prerecord is None:
+            raise RuntimeError("Not pre-recording")
+        logging.getLogger(__name__).debug("Save pre-recording to %s",
+                                          filename)
+        output = _TriggeredOutput(filename)
+        self._camera.split_recording(output,
+                                     splitter_port=RECORDING_SPLITTER_PORT)
+        self._prerecord.copy_to(output.file)
+        output.release()
+        self._prerecord = None
+        self._recording_output = output
+
+    def stop_recording(self):
+        logging.getLogger(__name__).debug("Stop recording")
+        self._camera.stop_recording(splitter_port=RECORDING_SPLITTER_PORT)
+        if self._recording_output is not None:
+            self._recording_output.close()
+        self._recording_output = None
+        self._prerecord = None
+        self._recording = False
@@ -0,0 +1,173 @@
+import logging
+import os.path
+import time
+
+import cv2
+
+from camera import BRACKET_STOPS, Image
+from catalog import make_thumbnail
+from stack import AverageStacker, FrameAligner, MertensStacker
+
+
+GROUP_BRACKET = "bracket"
+
+
+# Width at which captured pictures are shown after being taken
+REVIEW_WIDTH = 480
+
+
+class Capturer:
+    # Takes pictures with the camera, queues them to the writer and records
+    # them in the storage catalog. Shared by the Qt Shutter and the headless
+    # server, it must only be used from one thread at a time.
+    def __init__(self, camera, storage, writer):
+        self.camera = camera
+        self.storage = storage
+        self.writer = writer
+        # A DenoiseWorker that single pictures go through before the writer,
+        # None to write them as captured
+        self.denoiser = None
+
+    def take_picture(self, filename):
+        # Returns the review image, or None if it can not be decoded
+        image_format = os.path.splitext(filename)[1][1:]
+        start = time.time()
+        stream = self.camera.capture_to_memory(image_format)
+        end = time.time()
+        logging.getLogger(__name__).debug("Image took %d seconds", end - start)
+        (self.denoiser or self.writer).write(filename, stream.getbuffer())
+
+        image = self._review(stream.getbuffer())
+        thumbnail = None
+        if image is not None:
+            thumbnail = make_thumbnail(image.array)
+        self._add_to_catalog(filename, start, stream.getbuffer().nbytes,
+                             thumbnail)
+        return image
+
+    def take_burst(self, filenames):
+        # Returns the review image of the last frame
+        last_stream = None
+
+        def write(filename, stream):
+            nonlocal last_stream
+            self.writer.write(filename, stream.getbuffer())
+            # No thumbnail, decoding every frame would slow the burst down
+            self._add_to_catalog(filename, time.time(),
+                                 stream.getbuffer().nbytes)
+            last_stream = stream
+
+        start = time.time()
+        self.camera.capture_burst(filenames, write)
+        end = time.time()
+        logging.getLogger(__name__).info("Burst of %d images captured at"
+                                         " %.1f fps", len(filenames),
+                                         len(filenames) / (end - start))
+
+        return self._review(last_stream.getbuffer())
+
+    def take_stack(self, filename, count: int):
+        # Averages count frames taken back to back into one picture. Each
+        # frame is aligned and added as soon as it is captured, so only the
+        # sum and the frame being captured are ever in memory.
+        stacker = AverageStacker()
+        aligner = FrameAligner()
+
+        def add(frame):
+            stacker.add(aligner.align(frame))
+
+        start = time.time()
+        self.camera.capture_frames(count, add)
+        logging.getLogger(__name__).info("Stacked %d frames in %.1f seconds",
+                                         count, time.time() - start)
+        return self._save_stacked(filename, stacker.result(), start)
+
+    def take_bracket(self, filenames, stops=BRACKET_STOPS,
+                     hdr_filename=None):
+        # One picture per exposure of stops (in EV from the metered one),
+        # recorded as a group in the catalog. With hdr_filename, they are
+        # also fused into that picture, which joins the group. Returns the
+        # review image of the fused picture, or of the metered one.
+        if len(filenames) != len(stops):
+            raise ValueError("Expected a filename per exposure")
+        group_filenames = list(filenames)
+        if hdr_filename is not None:
+            group_filenames.append(hdr_filename)
+        group_id = self.storage.add_group(GROUP_BRACKET, group_filenames)
+        streams = []
+
+        def write(step, stream):
+            filename = filenames[len(streams)]
+            self.writer.write(filename, stream.getbuffer())
+            # Added now, while the camera settings are the step's
+            self._add_to_catalog(filename, time.time(),
+                                 stream.getbuffer().nbytes,
+                                 group_id=group_id)
+            streams.append(stream)
+
+        start = time.time()
+        image_format = os.path.splitext(filenames[0])[1][1:]
+        plan = self.camera.capture_bracket(stops, image_format, write)
+        logging.getLogger(__name__).info("Bracket of %d exposures captured in"
+                                         " %.1f seconds", len(plan),
+                                         time.time() - start)
+
+        if hdr_filename is not None:
+            result = self._stack(MertensStacker(), streams)
+            return self._save_stacked(hdr_filename, result, start, group_id)
+        metered = min(range(len(plan)), key=lambda i: abs(plan[i].ev))
+        return self._review(streams[metered].getbuffer())
+
+    @staticmethod
+    def _stack(stacker, streams):
+        # The frames stay encoded in memory and are decoded one at a time
+        # into the stacker, once per pass, so only a few of them are ever
+        # decoded at once
+        for pass_index in range(stacker.passes):
+            aligner = FrameAligner()
+            for stream in streams:
+                frame = Image.from_bytes(stream.getbuffer()).array
+                stacker.add(aligner.align(frame), pass_index)
+        return stacker.result()
+
+    def _save_stacked(self, filename, result, captured_at, group_id=None):
+        ok, data = cv2.imencode(os.path.splitext(filename)[1], result)
+        if not ok:
+            raise ValueError(f"Could not encode {filename}")
+        data = data.tobytes()
+        self.writer.write(filename, data)
+        self._add_to_catalog(filename, captured_at, len(data),
+                             make_thumbnail(result), group_id)
+        return self._review(data)
+
+    def run_timelapse(self, timelapse):
+        # The same exposure is used for every picture of the timelapse
+        self.camera.lock_exposure()
+        try:
+            timelapse.run()
+        finally:
+            self.camera.unlock_exposure()
+
+    def _add_to_catalog(self, filename, captured_at, size, thumbnail=None,
+                        group_id=None):
+        try:
+            self.storage.add_capture(filename, captured_at, size,
+                                     self.camera.get_resolution(),
+                                     self.camera.get_settings(), thumbnail,
+                                     group_id)
+        except Exception:
+            logging.getLogger(__name__).exception("Could not add %s to the"
+                                                  " catalog", filename)
+
+    def _review(self, data):
+        # Decode the captured data at about the review size instead of
+        # reading the full image back from disk
+        width, _ = self.camera.get_resolution()
+        reduce = 1
+        while reduce < 8 and width // (reduce * 2) >= REVIEW_WIDTH:
+            reduce *= 2
+
+        image = Image.from_bytes(data, reduce)
+        if image.array is None:
+            return None
+        return image
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+
+import cv2
+
+
+THUMBNAIL_WIDTH = 140
+THUMBNAIL_QUALITY = 80
+
+# Camera settings stored with every capture, see Camera.get_settings
+SETTINGS_COLUMNS = ["iso", "shutter_speed", "exposure_speed", "exposure_mode",
+                    "awb_mode", "awb_red", "awb_blue", "brightness",
+                    "contrast", "framerate"]
+COLUMNS = ["id", "name", "captured_at", "size", "width", "height", "format",
+           "group_id"] + SETTINGS_COLUMNS
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    captured_at REAL NOT NULL,
+    size INTEGER,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    iso INTEGER,
+    shutter_speed INTEGER,
+    exposure_speed INTEGER,
+    exposure_mode TEXT,
+    awb_mode TEXT,
+    awb_red REAL,
+    awb_blue REAL,
+    brightness INTEGER,
+    contrast INTEGER,
+    framerate REAL,
+    thumbnail BLOB,
+    group_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_captured_at ON captures (captured_at);
+-- Captures taken together, e.g. an exposure bracket. The id of a group is
+-- the id of its first capture.
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def make_thumbnail(bgr_array, width: int = THUMBNAIL_WIDTH) -> bytes:
+    height = max(round(bgr_array.shape[0] * width / bgr_array.shape[1]), 1)
+    thumbnail = cv2.resize(bgr_array, (width, height),
+                           interpolation=cv2.INTER_AREA)
+    ok, data = cv2.imencode(".jpg", thumbnail,
+                            [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+    return data.tobytes()
+
+
+class Catalog:
+    # SQLite database with one row per capture, so captures can be listed
+    # and filtered without opening the images
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # Commits do not wait for the SD card on every capture
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+
+    def _migrate(self):
+        # Catalogs created before groups existed lack the column
+        columns = [row["name"] for row in self._connection.execute(
+            "PRAGMA table_info(captures)")]
+        if "group_id" not in columns:
+            self._connection.execute(
+                "ALTER TABLE captures ADD COLUMN group_id INTEGER")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS captures_group"
+                                 " ON captures (group_id)")
+
+    def close(self):
+        self._connection.close()
+
+    def add(self, img_id: int, name: str, captured_at: float, size: int,
+            width: int, height: int, image_format: str, settings: dict,
+            thumbnail: bytes = None, group_id: int = None):
+        values = {"id": img_id, "name": name, "captured_at": captured_at,
+                  "size": size, "width": width, "height": height,
+                  "format": image_format, "thumbnail": thumbnail,
+                  "group_id": group_id}
+        values.update((k, settings.get(k)) for k in SETTINGS_COLUMNS)
+        columns = ", ".join(values)
+        placeholders = ", ".join(f":{k}" for k in values)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO captures ({columns})"
+                f" VALUES ({placeholders})", values)
+
+    def captures(self, since: float = None, until: float = None,
+                 limit: int = None, offset: int = 0, **filters):
+        # Newest first. filters are exact matches on the other columns,
+        # e.g. captures(iso=800, format="png")
+        conditions = []
+        values = []
+        if since is not None:
+            conditions.append("captured_at >= ?")
+            values.append(since)
+        if until is not None:
+            conditions.append("captured_at < ?")
+            values.append(until)
+        for column, value in filters.items():
+            if column not in COLUMNS:
+                raise ValueError(f"Invalid column {column}")
+            conditions.append(f"{column} = ?")
+            values.append(value)
+
+        query = f"SELECT {', '.join(COLUMNS)} FROM captures"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC LIMIT ? OFFSET ?"
+        values += [-1 if limit is None else limit, offset]
+        with self._lock:
+            rows = self._connection.execute(query, values).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_group(self, group_id: int, kind: str, created_at: float):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO groups (id, kind, created_at)"
+                " VALUES (?, ?, ?)", (group_id, kind, created_at))
+
+    def group(self, group_id: int):
+        # The group with its captures in the order they were taken
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, kind, created_at FROM groups WHERE id = ?",
+                (group_id,)).fetchone()
+            if row is None:
+                return None
+            captures = self._connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM captures"
+                " WHERE group_id = ? ORDER BY id", (group_id,)).fetchall()
+        group = dict(row)
+        group["captures"] = [dict(capture) for capture in captures]
+        return group
+
+    def get(self, img_id: int):
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM captures WHERE id = ?",
+                (img_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def thumbnail(self, img_id: int):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT thumbnail FROM captures WHERE id = ?",
+                (img_id,)).fetchone()
+        return row["thumbnail"] if row is not None else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM captures").fetchone()[0]
@@ -0,0 +1,156 @@
+import logging
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from camera import Image
+
+
+DENOISE_FAST = "fast"  # bilateral filter
+DENOISE_QUALITY = "quality"  # non-local means, seconds per picture on a Pi
+DENOISE_MODES = [DENOISE_FAST, DENOISE_QUALITY]
+
+# Rows denoised between checks for cancellation
+DENOISE_STRIP_HEIGHT = 128
+BILATERAL_DIAMETER = 5
+BILATERAL_SIGMA_COLOR = 30
+BILATERAL_SIGMA_SPACE = 5
+NLMEANS_STRENGTH = 5
+NLMEANS_TEMPLATE_SIZE = 7
+NLMEANS_SEARCH_SIZE = 21
+# Weight of each new frame in the preview running average
+TEMPORAL_WEIGHT = 0.5
+# Pictures waiting to be denoised, more are written as captured so they do
+# not pile up in memory when denoising is slower than capturing
+DENOISE_MAX_QUEUED = 2
+
+
+class DenoiseCancelled(Exception):
+    pass
+
+
+def _filter(mode):
+    # Returns the filter and how many rows around a pixel it reads
+    if mode == DENOISE_FAST:
+        return (lambda array: cv2.bilateralFilter(
+                    array, BILATERAL_DIAMETER, BILATERAL_SIGMA_COLOR,
+                    BILATERAL_SIGMA_SPACE),
+                BILATERAL_DIAMETER // 2)
+    if mode == DENOISE_QUALITY:
+        return (lambda array: cv2.fastNlMeansDenoisingColored(
+                    array, None, NLMEANS_STRENGTH, NLMEANS_STRENGTH,
+                    NLMEANS_TEMPLATE_SIZE, NLMEANS_SEARCH_SIZE),
+                NLMEANS_SEARCH_SIZE // 2 + NLMEANS_TEMPLATE_SIZE // 2)
+    raise ValueError(f"Invalid denoise mode {mode}")
+
+
+def denoise(array, mode: str, cancelled=None):
+    # Returns a denoised copy of the array. It is processed in strips that
+    # overlap by what the filter reads around each pixel, so cancelled() is
+    # checked regularly and DenoiseCancelled raised when it returns True.
+    apply, margin = _filter(mode)
+    result = np.empty_like(array)
+    height = array.shape[0]
+    for top in range(0, height, DENOISE_STRIP_HEIGHT):
+        if cancelled is not None and cancelled():
+            raise DenoiseCancelled()
+        bottom = min(top + DENOISE_STRIP_HEIGHT, height)
+        start = max(top - margin, 0)
+        end = min(bottom + margin, height)
+        strip = apply(np.ascontiguousarray(array[start:end]))
+        result[top:bottom] = strip[top - start:bottom - start]
+    return result
+
+
+class TemporalDenoiser:
+    # Running average of the preview frames. Sensor noise is averaged out at
+    # almost no cost, moving objects leave a short trail. The returned image
+    # is only valid until the next call to apply.
+    def __init__(self, weight: float = TEMPORAL_WEIGHT):
+        self.weight = weight
+        self._average = None
+        self._output = None
+
+    def reset(self):
+        self._average = None
+
+    def apply(self, image: Image) -> Image:
+        array = image.array
+        if self._average is None or self._average.shape != array.shape:
+            self._average = array.astype(np.float32)
+            self._output = np.empty_like(array)
+        else:
+            cv2.accumulateWeighted(array, self._average, self.weight)
+        cv2.convertScaleAbs(self._average, dst=self._output)
+        return Image(self._output, image.color_order)
+
+
+class DenoiseWorker:
+    # Denoises captured pictures on its own thread and queues them to the
+    # writer, so the capture thread only hands over the encoded data.
+    #
+    # cancel() abandons the picture being denoised and the queued ones. They
+    # are written as captured, so no picture is lost.
+    def __init__(self, writer, mode: str = DENOISE_QUALITY,
+                 max_queued: int = DENOISE_MAX_QUEUED):
+        _filter(mode)  # validate
+        self.mode = mode
+        self._writer = writer
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_queued)
+        self._generation = 0
+        self._thread = None
+        self.skipped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="Denoise",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Pending pictures are written without denoising
+        self.cancel()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def write(self, filename: str, data):
+        if not self._slots.acquire(blocking=False):
+            logging.getLogger(__name__).warning("Denoise queue full, writing"
+                                                " %s as captured", filename)
+            self.skipped += 1
+            self._writer.write(filename, data)
+            return
+        self._queue.put((filename, data, self.mode, self._generation))
+
+    def cancel(self):
+        self._generation += 1
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            filename, data, mode, generation = job
+            try:
+                self._writer.write(filename, self._denoise(data, mode,
+                                                           generation))
+            except DenoiseCancelled:
+                logging.getLogger(__name__).info("Denoising %s cancelled",
+                                                 filename)
+                self._writer.write(filename, data)
+            except Exception:
+                logging.getLogger(__name__).exception("Could not denoise %s",
+                                                      filename)
+                self._writer.write(filename, data)
+            finally:
+                self._slots.release()
+
+    def _denoise(self, data, mode, generation):
+        image = Image.from_bytes(data)
+        if image.array is None:
+            raise ValueError("Could not decode the image")
+        return denoise(image.array, mode,
+                       lambda: generation != self._generation)
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+
+# Subscribers hold at most two frames each (the one they are using and the
+# one waiting in their mailbox). Held frames are not overwritten, so this
+# many subscribers are served from a preview ring of twice as many buffers
+# plus the one being written without it having to grow.
+MAX_SUBSCRIBERS = 4
+# Wait before restarting the preview after it failed
+RESTART_DELAY = 1.0
+
+
+class FrameMailbox:
+    # Single slot holding the latest frame. A frame that is replaced before
+    # being consumed is dropped, so the consumer is never more than one frame
+    # behind the producer.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self.dropped = 0
+
+    def put(self, frame) -> bool:
+        # Returns whether the mailbox was empty, i.e. whether the consumer
+        # must be notified.
+        with self._lock:
+            was_empty = self._frame is None
+            if not was_empty:
+                self.dropped += 1
+            self._frame = frame
+            return was_empty
+
+    def get(self):
+        with self._lock:
+            frame, self._frame = self._frame, None
+            return frame
+
+    def empty(self) -> bool:
+        with self._lock:
+            return self._frame is None
+
+
+class Subscription(FrameMailbox):
+    # A subscriber's view of the bus. notify() is called from the producer
+    # thread when a frame arrives in an empty mailbox; the frame is read-only
+    # and valid until the subscriber gets the next one or unsubscribes: its
+    # preview buffer is held meanwhile.
+    def __init__(self, resolution=None, max_fps: float = None, notify=None):
+        super().__init__()
+        self.resolution = resolution
+        self.min_interval = 1 / max_fps if max_fps else 0
+        self.notify = notify
+        self.delivered = 0
+        self._last_delivery = None
+        # (ring, index) of the pending and of the current frame
+        self._buffers_lock = threading.Lock()
+        self._closed = False
+        self._pending_buffer = None
+        self._current_buffer = None
+
+    def offer(self, frame, ring, index: int, now: float):
+        if (self._last_delivery is not None
+                and now - self._last_delivery < self.min_interval):
+            return
+        self._last_delivery = now
+        self.delivered += 1
+        with self._buffers_lock:
+            if self._closed:
+                return
+            ring.hold(index)
+            replaced = self._pending_buffer
+            self._pending_buffer = (ring, index)
+            was_empty = self.put(frame)
+        if replaced is not None:
+            _release(replaced)
+        if was_empty and self.notify is not None:
+            self.notify()
+
+    def get(self):
+        with self._buffers_lock:
+            frame = super().get()
+            if frame is None:
+                return None
+            previous = self._current_buffer
+            self._current_buffer, self._pending_buffer = \
+                self._pending_buffer, None
+        if previous is not None:
+            _release(previous)
+        return frame
+
+    def close(self):
+        # Called on unsubscribe, the frames can not be used anymore
+        with self._buffers_lock:
+            self._closed = True
+            buffers = [self._current_buffer, self._pending_buffer]
+            self._current_buffer = self._pending_buffer = None
+            super().get()
+        for buffer in buffers:
+            if buffer is not None:
+                _release(buffer)
+
+
+def _release(buffer):
+    ring, index = buffer
+    ring.release(index)
+
+
+class FrameBus:
+    # Reads the preview frames of the camera on a single thread and hands
+    # them to every subscriber, so the sensor is read once whatever the
+    # number of consumers. The producer runs while there are subscribers, at
+    # the largest resolution they asked for.
+    def __init__(self, camera):
+        self._camera = camera
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._resolution = None
+        self._restart = False
+        self._thread = None
+
+    def subscribe(self, resolution=None, max_fps: float = None,
+                  notify=None) -> Subscription:
+        subscription = Subscription(resolution, max_fps, notify)
+        with self._lock:
+            if len(self._subscribers) == MAX_SUBSCRIBERS:
+                raise RuntimeError("Too many frame subscribers")
+            self._subscribers.append(subscription)
+            self._update_resolution()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="FrameBus", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+                self._update_resolution()
+        subscription.close()
+        logging.getLogger(__name__).debug(
+            "Subscriber got %d frames and dropped %d",
+            subscription.delivered, subscription.dropped)
+
+    def stop(self):
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        for subscription in subscribers:
+            subscription.close()
+
+    def _update_resolution(self):
+        # None, i.e. full resolution, wins over any size
+        resolutions = [s.resolution for s in self._subscribers]
+        if not resolutions:
+            return
+        if None in resolutions:
+            resolution = None
+        else:
+            resolution = (max(width for width, _ in resolutions),
+                          max(height for _, height in resolutions))
+        if resolution != self._resolution:
+            self._resolution = resolution
+            self._restart = True
+
+    def _run(self):
+        logging.getLogger(__name__).debug("Frame bus started")
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    logging.getLogger(__name__).debug("Frame bus stopped")
+                    return
+                resolution = self._resolution
+                self._restart = False
+
+            ring_size = 2 * MAX_SUBSCRIBERS + 1
+            try:
+                for image, ring, index in self._camera.preview(resolution,
+                                                               ring_size):
+                    frame = image.read_only()
+                    now = time.monotonic()
+                    with self._lock:
+                        subscribers = list(self._subscribers)
+                        if self._restart or not subscribers:
+                            break
+                    for subscription in subscribers:
+                        subscription.offer(frame, ring, index, now)
+            except Exception:
+                # Keep serving the subscribers, the camera may recover
+                logging.getLogger(__name__).exception("Preview failed")
+                time.sleep(RESTART_DELAY)
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import queue
+import threading
 import time
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
+from camera import BRACKET_STOPS
+from capture import Capturer
+from denoise import DenoiseWorker, TemporalDenoiser
+from motion import MotionTrigger
+from timelapse import Timelapse
+from writer import ImageWriter
+
 try:
     from camera import Image
 except ModuleNotFoundError:
@@ -31,54 +40,65 @@ class _ImageWidget(QtWidgets.QLabel):
         self.clear()
 
 
-class _PreviewWorker(QObject):
+class _ShutterWorker(QObject):
+    start_capture = pyqtSignal()
     finished = pyqtSignal()
-    new_frame = pyqtSignal(Image)
+    captured = pyqtSignal(Image)
+    timelapse_progress = pyqtSignal(int)
 
-    def __init__(self, camera):
+    def __init__(self, capturer):
         super().__init__()
-        self.camera = camera
-        self._is_running = False
+        self.capturer = capturer
+        self._commands = queue.Queue()
 
-    def run(self):
-        logging.getLogger(__name__).debug("Preview worker started")
-        self._is_running = True
+    def submit(self, action, *args):
+        # action is run with args in the worker thread
+        self._commands.put((action, args))
+
+    def stop(self):
+        self._commands.put(None)
 
-        for frame in self.camera.preview():
-            logging.getLogger(__name__).debug("New image")
-            self.new_frame.emit(frame)
-            if not self._is_running:
+    def run(self):
+        logging.getLogger(__name__).debug("Shutter worker started")
+        while True:
+            command = self._commands.get()
+            if command is None:
                 break
 
+            action, args = command
+            try:
+                action(*args)
+            except Exception:
+                logging.getLogger(__name__).exception("Could not take picture")
             self.finished.emit()
 
-    def stop(self):
-        self._is_running = False
-
+    def take_picture(self, filename, delay):
+        time.sleep(delay)
+        self.start_capture.emit()
+        self._emit_review(self.capturer.take_picture(filename))
 
-class _ShutterWorker(QObject):
-    start_capture = pyqtSignal()
-    finished = pyqtSignal()
-    captured = pyqtSignal(Image)
+    def take_burst(self, filenames, delay):
+        time.sleep(delay)
+        self.start_capture.emit()
+        self._emit_review(self.capturer.take_burst(filenames))
 
-    def __init__(self, camera, filename, delay):
-        super().__init__()
-        self.camera = camera
-        self.filename = filename
-        self.delay = delay
+    def take_stack(self, filename, count, delay):
+        time.sleep(delay)
+        self.start_capture.emit()
+        self._emit_review(self.capturer.take_stack(filename, count))
 
-    def run(self):
-        time.sleep(self.delay)
+    def take_bracket(self, filenames, stops, hdr_filename, delay):
+        time.sleep(delay)
         self.start_capture.emit()
+        self._emit_review(self.capturer.take_bracket(filenames, stops,
+                                                     hdr_filename))
 
-        start = time.time()
-        self.camera.take_picture(self.filename)
-        end = time.time()
-        logging.getLogger(__name__).info("Image saved at %s", self.filename)
-        logging.getLogger(__name__).debug("Image took %d seconds", end - start)
+    def run_timelapse(self, timelapse):
+        self.capturer.run_timelapse(timelapse)
 
-        self.captured.emit(Image.from_file(self.filename))
-        self.finished.emit()
+    def _emit_review(self, image):
+        if image is not None:
+            self.captured.emit(image)
 
 
 class Shutter(QObject):
@@ -86,53 +106,202 @@ class Shutter(QObject):
     start_capture = pyqtSignal()
     captured = pyqtSignal(Image)
     finished = pyqtSignal()
+    timelapse_progress = pyqtSignal(int)
+    motion_detected = pyqtSignal(int)
 
-    def __init__(self, camera, storage):
+    def __init__(self, camera, storage, writer: ImageWriter = None):
         super().__init__()
 
         self.camera = camera
         self.storage = storage
-        self._worker = None
-        self._thread = None
         self.capture_format = None
         self._delay = 0
+        self._timelapse = None
+        self._motion = None
 
-    def take_picture(self):
-        self.start.emit()
-        filename = self.storage.get_new_name(self.capture_format)
+        # Pictures are captured to memory and written in the background
+        self._writer = writer or ImageWriter()
+        self._writer.start()
 
+        self._denoiser = DenoiseWorker(self._writer)
+        self._denoiser.start()
+
+        # A single long-lived thread takes all the pictures, requests are
+        # queued to it
         self._thread = QThread()
-        self._worker = _ShutterWorker(self.camera, filename, self._delay)
-        # move the worker to the thread
+        self._capturer = Capturer(self.camera, self.storage, self._writer)
+        self._worker = _ShutterWorker(self._capturer)
         self._worker.moveToThread(self._thread)
 
-        # connect signals and slots
         self._thread.started.connect(self._worker.run)
-
-        self._worker.finished.connect(self._thread.quit)
-        self._worker.finished.connect(self._worker.deleteLater)
-        self._thread.finished.connect(self._thread.deleteLater)
-
-        # extend worker signals
         self._worker.finished.connect(self.finished.emit)
         self._worker.captured.connect(self.captured.emit)
         self._worker.start_capture.connect(self.start_capture)
+        self._worker.timelapse_progress.connect(self.timelapse_progress.emit)
 
-        # Run the thread
         self._thread.start()
 
+    def take_picture(self):
+        self.start.emit()
+        filename = self.storage.get_new_name(self.capture_format)
+        self._worker.submit(self._worker.take_picture, filename, self._delay)
+
+    def take_burst(self, count: int):
+        self.start.emit()
+        filenames = self.storage.get_new_names(self.capture_format, count)
+        self._worker.submit(self._worker.take_burst, filenames, self._delay)
+
+    def take_stack(self, count: int):
+        # A single picture averaged from count frames, see
+        # Capturer.take_stack
+        self.start.emit()
+        filename = self.storage.get_new_name(self.capture_format)
+        self._worker.submit(self._worker.take_stack, filename, count,
+                            self._delay)
+
+    def take_bracket(self, stops=BRACKET_STOPS, hdr: bool = False):
+        # A picture per exposure of stops, optionally fused into one more,
+        # see Capturer.take_bracket
+        self.start.emit()
+        filenames = self.storage.get_new_names(self.capture_format,
+                                               len(stops) + hdr)
+        hdr_filename = filenames.pop() if hdr else None
+        self._worker.submit(self._worker.take_bracket, filenames, stops,
+                            hdr_filename, self._delay)
+
+    def start_timelapse(self, interval: float, count: int = None):
+        self.start.emit()
+        image_format = self.capture_format
+
+        # Runs in the worker thread
+        def capture(index):
+            filename = self.storage.get_new_name(image_format)
+            self._worker.take_picture(filename, 0)
+            self._worker.timelapse_progress.emit(index + 1)
+
+        self._timelapse = Timelapse(capture, interval, count)
+        self._worker.submit(self._worker.run_timelapse, self._timelapse)
+
+    def stop_timelapse(self):
+        if self._timelapse is not None:
+            self._timelapse.stop()
+            self._timelapse = None
+
+    def start_motion_capture(self, count: int = 1, **options):
+        # Takes a picture, or a burst of count, each time motion is seen in
+        # the preview. options are passed to MotionTrigger.
+        def capture():
+            if count > 1:
+                self.take_burst(count)
+            else:
+                self.take_picture()
+            self.motion_detected.emit(self._motion.triggered)
+
+        self._motion = MotionTrigger(self.camera, capture, **options)
+        self._motion.start()
+
+    def stop_motion_capture(self):
+        if self._motion is not None:
+            self._motion.stop()
+            self._motion = None
+
+    def set_denoise(self, mode: str = None):
+        # Single pictures are denoised in the background before being
+        # written, bursts are not. None turns it off and writes the pending
+        # pictures as captured.
+        if mode is None:
+            self._capturer.denoiser = None
+            self._denoiser.cancel()
+        else:
+            self._denoiser.mode = mode
+            self._capturer.denoiser = self._denoiser
+
+    def close(self):
+        self.stop_timelapse()
+        self.stop_motion_capture()
+        self._worker.stop()
+        self._thread.quit()
+        self._thread.wait()
+        self._denoiser.stop()
+        self._writer.stop()
+
     def set_delay(self, value: int):
         logging.getLogger(__name__).debug("Set delay value to %d", value)
         self._delay = value
 
 
+class _ThumbnailWorker(QObject):
+    loaded = pyqtSignal(int, QtGui.QImage)
+
+    def __init__(self, thumbnails):
+        super().__init__()
+        self.thumbnails = thumbnails
+        self._condition = threading.Condition()
+        self._pending = []
+        self._is_running = False
+
+    def request(self, img_ids):
+        # Replaces the pending requests, ids that are no longer wanted (e.g.
+        # scrolled out of view) are not loaded
+        with self._condition:
+            self._pending = list(img_ids)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._is_running = False
+            self._condition.notify()
+
+    def run(self):
+        self._is_running = True
+        while True:
+            with self._condition:
+                while self._is_running and not self._pending:
+                    self._condition.wait()
+                if not self._is_running:
+                    break
+                img_id = self._pending.pop(0)
+
+            try:
+                data = self.thumbnails.get(img_id)
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Could not load thumbnail %d", img_id)
+                continue
+            if data is not None:
+                self.loaded.emit(img_id, QtGui.QImage.fromData(data))
+
+
+class ThumbnailLoader(QObject):
+    loaded = pyqtSignal(int, QtGui.QImage)
+
+    def __init__(self, thumbnails):
+        super().__init__()
+        self._thread = QThread()
+        self._worker = _ThumbnailWorker(thumbnails)
+        self._worker.moveToThread(self._thread)
+        self._thread.started.connect(self._worker.run)
+        self._worker.loaded.connect(self.loaded.emit)
+        self._thread.start()
+
+    def request(self, img_ids):
+        self._worker.request(img_ids)
+
+    def close(self):
+        self._worker.stop()
+        self._thread.quit()
+        self._thread.wait()
+
+
 class PreviewWidget(QtWidgets.QWidget):
+    # Emitted from the frame bus thread, so it is queued to the GUI thread
+    _frame_ready = pyqtSignal()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.camera = None
-        self._preview_queue = None
-        self._preview_thread = None
-        self._preview_worker = None
+        self._subscription = None
+        self._denoiser = None
         self._is_running = False
 
         # Qt elements
@@ -144,6 +313,8 @@ class PreviewWidget(QtWidgets.QWidget):
         layout.addWidget(self._labelInfo)
         self.setLayout(layout)
 
+        self._frame_ready.connect(self._show_preview_image)
+
     def set_camera(self, cam):
         self.camera = cam
 
@@ -156,33 +327,43 @@ class PreviewWidget(QtWidgets.QWidget):
     def set_info_message(self, message: str):
         self._labelInfo.setText(message)
 
+    def set_denoise(self, enabled: bool):
+        # The full denoise modes are too slow for the preview, it is
+        # averaged over time instead
+        self._denoiser = TemporalDenoiser() if enabled else None
+
     def start_preview(self):
         logging.getLogger(__name__).debug("Start preview")
-        self._preview_thread = QThread()
-        self._preview_worker = _PreviewWorker(self.camera)
-        self._preview_worker.moveToThread(self._preview_thread)
-        self._preview_thread.started.connect(self._preview_worker.run)
-        self._preview_thread.finished.connect(self._preview_thread.deleteLater)
-        self._preview_worker.finished.connect(self._preview_thread.quit)
-        self._preview_worker.finished.connect(self._preview_worker.deleteLater)
-        self._preview_worker.new_frame.connect(self._image.set_image)
-
-        self._preview_thread.start()
+        # Only notified when the GUI has consumed the previous frame, so at
+        # most one event is queued no matter how slow it is.
+        self._subscription = self.camera.frames.subscribe(
+            self._preview_resolution(), notify=self._frame_ready.emit)
         self._is_running = True
 
+    def _preview_resolution(self):
+        # Ask for frames of the size they are displayed at
+        size = self._image.size()
+        if size.isEmpty():
+            return None
+        return (size.width(), size.height())
+
     def stop_preview(self):
         if self._is_running:
             logging.getLogger(__name__).debug("Stop preview")
-            self._preview_worker.stop()
-            self._preview_worker.new_frame.disconnect()
+            self.camera.frames.unsubscribe(self._subscription)
+            self._subscription = None
             self.hide_image()
             self._is_running = False
 
     def _show_preview_image(self):
-        if self._preview_queue.empty():
+        if self._subscription is None:
+            return  # stopped after the frame was queued
+        image = self._subscription.get()
+        if image is None:
             return
 
-        image = self._preview_queue.get()
+        if self._denoiser is not None:
+            image = self._denoiser.apply(image)
         self.set_image(image)
 
     def is_running(self):
@@ -191,6 +372,7 @@ class PreviewWidget(QtWidgets.QWidget):
 
 class ImgViewer(QtWidgets.QWidget):
     fullscreen_on = QtCore.pyqtSignal()
+    gallery_on = QtCore.pyqtSignal()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -198,18 +380,28 @@ class ImgViewer(QtWidgets.QWidget):
         # QT elements
         self._preview = PreviewWidget()
         self.buttonFullscreen = QtWidgets.QPushButton("Fullscreen")
+        self.buttonGallery = QtWidgets.QPushButton("Gallery")
 
         self.buttonFullscreen.clicked.connect(self.open_fullscreen)
+        self.buttonGallery.clicked.connect(self.open_gallery)
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(self.buttonFullscreen)
+        buttons.addWidget(self.buttonGallery)
 
         layout = QtWidgets.QVBoxLayout(self)
         layout.addWidget(self._preview)
-        layout.addWidget(self.buttonFullscreen)
+        layout.addLayout(buttons)
         self.setLayout(layout)
 
     def open_fullscreen(self):
         self.stop_preview()
         self.fullscreen_on.emit()
 
+    def open_gallery(self):
+        self.stop_preview()
+        self.gallery_on.emit()
+
     def set_camera(self, cam):
         self._preview.set_camera(cam)
 
@@ -222,6 +414,9 @@ class ImgViewer(QtWidgets.QWidget):
     def set_info_message(self, text: str):
         self._preview.set_info_message(text)
 
+    def set_denoise(self, enabled: bool):
+        self._preview.set_denoise(enabled)
+
     def start_preview(self):
         self._preview.start_preview()
 
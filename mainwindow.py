@@ -145,6 +145,8 @@ class Ui_Form(object):
         self.label_4.setObjectName("label_4")
         self.formLayout_2.setWidget(0, QtWidgets.QFormLayout.LabelRole, self.label_4)
         self.spinboxTimelapseDelay = QtWidgets.QSpinBox(self.tabTimelapse)
+        self.spinboxTimelapseDelay.setMinimum(1)
+        self.spinboxTimelapseDelay.setMaximum(86400)
         self.spinboxTimelapseDelay.setObjectName("spinboxTimelapseDelay")
         self.formLayout_2.setWidget(0, QtWidgets.QFormLayout.FieldRole, self.spinboxTimelapseDelay)
         self.label_5 = QtWidgets.QLabel(self.tabTimelapse)
@@ -152,8 +154,33 @@ class Ui_Form(object):
         self.formLayout_2.setWidget(1, QtWidgets.QFormLayout.LabelRole, self.label_5)
         self.spinboxTimelapseCount = QtWidgets.QSpinBox(self.tabTimelapse)
         self.spinboxTimelapseCount.setMinimum(1)
+        self.spinboxTimelapseCount.setMaximum(1000000)
         self.spinboxTimelapseCount.setObjectName("spinboxTimelapseCount")
         self.formLayout_2.setWidget(1, QtWidgets.QFormLayout.FieldRole, self.spinboxTimelapseCount)
+        self.btnTimelapse = QtWidgets.QPushButton(self.tabTimelapse)
+        self.btnTimelapse.setCheckable(True)
+        self.btnTimelapse.setObjectName("btnTimelapse")
+        self.formLayout_2.setWidget(2, QtWidgets.QFormLayout.SpanningRole, self.btnTimelapse)
+        self.labelTimelapseStatus = QtWidgets.QLabel(self.tabTimelapse)
+        self.labelTimelapseStatus.setText("")
+        self.labelTimelapseStatus.setObjectName("labelTimelapseStatus")
+        self.formLayout_2.setWidget(3, QtWidgets.QFormLayout.SpanningRole, self.labelTimelapseStatus)
+        self.labelMotionCount = QtWidgets.QLabel(self.tabTimelapse)
+        self.labelMotionCount.setObjectName("labelMotionCount")
+        self.formLayout_2.setWidget(4, QtWidgets.QFormLayout.LabelRole, self.labelMotionCount)
+        self.spinboxMotionCount = QtWidgets.QSpinBox(self.tabTimelapse)
+        self.spinboxMotionCount.setMinimum(1)
+        self.spinboxMotionCount.setMaximum(100)
+        self.spinboxMotionCount.setObjectName("spinboxMotionCount")
+        self.formLayout_2.setWidget(4, QtWidgets.QFormLayout.FieldRole, self.spinboxMotionCount)
+        self.btnMotion = QtWidgets.QPushButton(self.tabTimelapse)
+        self.btnMotion.setCheckable(True)
+        self.btnMotion.setObjectName("btnMotion")
+        self.formLayout_2.setWidget(5, QtWidgets.QFormLayout.SpanningRole, self.btnMotion)
+        self.labelMotionStatus = QtWidgets.QLabel(self.tabTimelapse)
+        self.labelMotionStatus.setText("")
+        self.labelMotionStatus.setObjectName("labelMotionStatus")
+        self.formLayout_2.setWidget(6, QtWidgets.QFormLayout.SpanningRole, self.labelMotionStatus)
         self.gridLayout_2.addLayout(self.formLayout_2, 0, 0, 1, 1)
         self.tabWidget.addTab(self.tabTimelapse, "")
         self.tabOtherSettings = QtWidgets.QWidget()
@@ -173,12 +200,31 @@ class Ui_Form(object):
         self.checkboxLed = QtWidgets.QCheckBox(self.scrollAreaWidgetContents_2)
         self.checkboxLed.setObjectName("checkboxLed")
         self.verticalLayout.addWidget(self.checkboxLed)
+        self.horizontalLayoutDenoise = QtWidgets.QHBoxLayout()
+        self.horizontalLayoutDenoise.setObjectName("horizontalLayoutDenoise")
         self.checkboxDenoise = QtWidgets.QCheckBox(self.scrollAreaWidgetContents_2)
         self.checkboxDenoise.setObjectName("checkboxDenoise")
-        self.verticalLayout.addWidget(self.checkboxDenoise)
+        self.horizontalLayoutDenoise.addWidget(self.checkboxDenoise)
+        self.comboboxDenoiseMode = QtWidgets.QComboBox(self.scrollAreaWidgetContents_2)
+        self.comboboxDenoiseMode.setObjectName("comboboxDenoiseMode")
+        self.comboboxDenoiseMode.addItem("")
+        self.comboboxDenoiseMode.addItem("")
+        self.horizontalLayoutDenoise.addWidget(self.comboboxDenoiseMode)
+        self.verticalLayout.addLayout(self.horizontalLayoutDenoise)
         self.buttonMaxFps = QtWidgets.QPushButton(self.scrollAreaWidgetContents_2)
         self.buttonMaxFps.setObjectName("buttonMaxFps")
         self.verticalLayout.addWidget(self.buttonMaxFps)
+        self.horizontalLayoutPreset = QtWidgets.QHBoxLayout()
+        self.horizontalLayoutPreset.setObjectName("horizontalLayoutPreset")
+        self.comboboxPreset = QtWidgets.QComboBox(self.scrollAreaWidgetContents_2)
+        self.comboboxPreset.setEditable(True)
+        self.comboboxPreset.setInsertPolicy(QtWidgets.QComboBox.NoInsert)
+        self.comboboxPreset.setObjectName("comboboxPreset")
+        self.horizontalLayoutPreset.addWidget(self.comboboxPreset)
+        self.buttonSavePreset = QtWidgets.QPushButton(self.scrollAreaWidgetContents_2)
+        self.buttonSavePreset.setObjectName("buttonSavePreset")
+        self.horizontalLayoutPreset.addWidget(self.buttonSavePreset)
+        self.verticalLayout.addLayout(self.horizontalLayoutPreset)
         self.formLayout_3 = QtWidgets.QFormLayout()
         self.formLayout_3.setObjectName("formLayout_3")
         self.label_13 = QtWidgets.QLabel(self.scrollAreaWidgetContents_2)
@@ -341,11 +387,18 @@ class Ui_Form(object):
         self.comboboxExposure.setItemText(12, _translate("Form", "Fireworks"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tabSettings), _translate("Form", "Image settings"))
         self.label_4.setText(_translate("Form", "Delay between"))
+        self.spinboxTimelapseDelay.setSuffix(_translate("Form", " s"))
         self.label_5.setText(_translate("Form", "# of pictures"))
+        self.btnTimelapse.setText(_translate("Form", "Start timelapse"))
+        self.labelMotionCount.setText(_translate("Form", "Pictures on motion"))
+        self.btnMotion.setText(_translate("Form", "Start motion capture"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tabTimelapse), _translate("Form", "Timelapse"))
         self.checkboxLed.setText(_translate("Form", "Led "))
         self.checkboxDenoise.setText(_translate("Form", "Denoise"))
+        self.comboboxDenoiseMode.setItemText(0, _translate("Form", "Fast"))
+        self.comboboxDenoiseMode.setItemText(1, _translate("Form", "Quality"))
         self.buttonMaxFps.setText(_translate("Form", "Force Max FPS"))
+        self.buttonSavePreset.setText(_translate("Form", "Save"))
         self.label_13.setText(_translate("Form", "Image format:"))
         self.comboboxImageFormat.setItemText(0, _translate("Form", "JPEG"))
         self.comboboxImageFormat.setItemText(1, _translate("Form", "PNG"))
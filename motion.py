@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+# Frames asked to the frame bus, the GPU resizer does most of the work
+MOTION_FRAME_SIZE = (160, 120)
+# Width of the grayscale image motion is detected on
+MOTION_WIDTH = 64
+# Gray level difference from the background for a pixel to have changed
+MOTION_THRESHOLD = 25
+# Fraction of the region that must change to detect motion
+MOTION_MIN_CHANGED = 0.02
+# Weight of each new frame in the background average
+MOTION_LEARNING_RATE = 0.05
+# Frames used to learn the background before detecting anything
+MOTION_WARMUP = 10
+MOTION_COOLDOWN = 5.0
+
+
+class MotionDetector:
+    # Compares each frame, downscaled to a tiny grayscale image, with a
+    # running average of the previous ones. The buffers are allocated on the
+    # first frame and reused.
+    #
+    # region is (x, y, width, height) in fractions of the frame, to only
+    # look at part of it.
+    def __init__(self, width: int = MOTION_WIDTH,
+                 threshold: int = MOTION_THRESHOLD,
+                 min_changed: float = MOTION_MIN_CHANGED,
+                 learning_rate: float = MOTION_LEARNING_RATE, region=None):
+        self.width = width
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.learning_rate = learning_rate
+        self.region = region
+        self._input_shape = None
+        self._frames = 0
+
+    def reset(self):
+        # Learn the background again, e.g. after the exposure changed
+        self._frames = 0
+
+    def _allocate(self, shape):
+        height, width = shape[:2]
+        small_height = max(1, round(height * self.width / width))
+        self._small = np.empty((small_height, self.width, 3), dtype=np.uint8)
+        self._gray = np.empty((small_height, self.width), dtype=np.uint8)
+        self._background = np.empty((small_height, self.width),
+                                    dtype=np.float32)
+        self._background_gray = np.empty_like(self._gray)
+        self._diff = np.empty_like(self._gray)
+
+        x, y, w, h = self.region or (0, 0, 1, 1)
+        self._region = (slice(int(y * small_height),
+                              max(int((y + h) * small_height), 1)),
+                        slice(int(x * self.width),
+                              max(int((x + w) * self.width), 1)))
+        self._region_size = self._diff[self._region].size
+        self._input_shape = shape
+        self._frames = 0
+
+    def changed(self, image) -> float:
+        # Fraction of the region that changed, 0 while learning the
+        # background
+        array = image.array
+        if array.shape != self._input_shape:
+            self._allocate(array.shape)
+
+        cv2.resize(array, self._small.shape[1::-1], dst=self._small,
+                   interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_RGB2GRAY
+                     if image.color_order == "rgb" else cv2.COLOR_BGR2GRAY,
+                     dst=self._gray)
+
+        self._frames += 1
+        if self._frames == 1:
+            self._background[:] = self._gray
+            return 0.0
+
+        cv2.convertScaleAbs(self._background, dst=self._background_gray)
+        cv2.absdiff(self._gray, self._background_gray, dst=self._diff)
+        cv2.threshold(self._diff, self.threshold, 255, cv2.THRESH_BINARY,
+                      dst=self._diff)
+        cv2.accumulateWeighted(self._gray, self._background,
+                               self.learning_rate)
+        if self._frames <= MOTION_WARMUP:
+            return 0.0
+        return cv2.countNonZero(self._diff[self._region]) / self._region_size
+
+    def detect(self, image) -> bool:
+        return self.changed(image) >= self.min_changed
+
+
+class MotionTrigger:
+    # Runs a MotionDetector on the camera preview frames in its own thread
+    # and calls on_motion() when it detects motion, at most once per
+    # cooldown seconds. The background is learnt again after each trigger,
+    # as the capture itself may disturb the preview.
+    def __init__(self, camera, on_motion, detector: MotionDetector = None,
+                 cooldown: float = MOTION_COOLDOWN, max_fps: float = None):
+        self._camera = camera
+        self._on_motion = on_motion
+        self.detector = detector or MotionDetector()
+        self.cooldown = cooldown
+        self._max_fps = max_fps
+        self.triggered = 0
+        self._subscription = None
+        self._frame_ready = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._subscription = self._camera.frames.subscribe(
+            MOTION_FRAME_SIZE, self._max_fps, notify=self._frame_ready.set)
+        self._thread = threading.Thread(target=self._run,
+                                        name="MotionTrigger", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._running = False
+        self._frame_ready.set()
+        self._thread.join()
+        self._thread = None
+        self._camera.frames.unsubscribe(self._subscription)
+        self._subscription = None
+
+    def _run(self):
+        logger = logging.getLogger(__name__)
+        logger.info("Start motion detection")
+        last_trigger = None
+        while True:
+            self._frame_ready.wait()
+            self._frame_ready.clear()
+            if not self._running:
+                break
+            image = self._subscription.get()
+            if image is None:
+                continue
+            if (last_trigger is not None
+                    and time.monotonic() - last_trigger < self.cooldown):
+                continue
+            if not self.detector.detect(image):
+                continue
+
+            logger.info("Motion detected")
+            last_trigger = time.monotonic()
+            self.triggered += 1
+            self.detector.reset()
+            try:
+                self._on_motion()
+            except Exception:
+                logger.exception("Motion capture failed")
+        logger.info("Motion detection stopped after %d triggers",
+                    self.triggered)
@@ -7,18 +7,25 @@ import sys
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget,
                              QStackedWidget, QScroller, QGridLayout,
-                             QPushButton)
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QFile, QIODevice
+                             QPushButton, QListWidget, QListWidgetItem,
+                             QListView, QVBoxLayout)
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QFile, QIODevice, QSize
+from PyQt5.QtGui import QIcon, QPixmap
 
 import mainwindow
 import img_viewer
-from img_viewer import Shutter, PreviewWidget
+from img_viewer import Shutter, PreviewWidget, ThumbnailLoader
 from storage import Storage
-from camera import Camera, REAL_CAMERA
+from camera import Camera, Image, REAL_CAMERA, parse_shutter_speed
+from catalog import THUMBNAIL_WIDTH
+from presets import PRESET_SETTINGS, Presets
+from thumbnails import ThumbnailCache
+from writer import ImageWriter
 
 
 BASE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 IMAGES_DIRECTORY = os.path.join(BASE_DIRECTORY, "images")
+PRESETS_FILE = os.path.join(BASE_DIRECTORY, "presets.json")
 CAPTURE_PREVIEW_TIMEOUT = 5
 
 
@@ -58,6 +65,7 @@ class SettingsWidget(QWidget, mainwindow.Ui_Form):
         self._init_camera(cam)
         self._shutter = shutter
         self._shutter.captured.connect(lambda img: self._display_image(img, CAPTURE_PREVIEW_TIMEOUT))
+        self._shutter.finished.connect(self._finished_shutter_thread)
 
         self.previewing = False
 
@@ -89,18 +97,23 @@ class SettingsWidget(QWidget, mainwindow.Ui_Form):
         self.comboboxDelay.currentTextChanged.connect(
             lambda val: self._shutter.set_delay(int(val)))
         # (1) Timelapse
-        self.spinboxTimelapseDelay.valueChanged.connect(
-            lambda val: print(val))
-        self.spinboxTimelapseDelay.setEnabled(False)
-        self.spinboxTimelapseCount.valueChanged.connect(
-            lambda val: print(val))
-        self.spinboxTimelapseCount.setEnabled(False)
+        self.btnTimelapse.toggled.connect(self.toggle_timelapse)
+        self._shutter.timelapse_progress.connect(self._timelapse_progress)
+        self.btnMotion.toggled.connect(self.toggle_motion)
+        self._shutter.motion_detected.connect(self._motion_detected)
         # (2) Other
         self.checkboxLed.stateChanged.connect(self._set_led)
-        self.checkboxDenoise.stateChanged.connect(
-            lambda val: print(val))
-        self.checkboxDenoise.setEnabled(False)
+        self.checkboxDenoise.stateChanged.connect(self._set_denoise)
+        self.comboboxDenoiseMode.currentTextChanged.connect(self._set_denoise)
         self.buttonMaxFps.clicked.connect(self.cam.maximize_fps)
+        self._presets = Presets(PRESETS_FILE)
+        self._presets.load()
+        self.comboboxPreset.addItems(self._presets.names())
+        self.comboboxPreset.setCurrentIndex(-1)
+        # Typing a new name and saving creates a preset
+        self.comboboxPreset.lineEdit().setPlaceholderText("Preset name")
+        self.comboboxPreset.activated[str].connect(self._apply_preset)
+        self.buttonSavePreset.clicked.connect(self._save_preset)
         self.comboboxImageFormat.currentTextChanged.connect(
             self._set_extension)
         self._set_extension(self.comboboxImageFormat.currentText())
@@ -146,6 +159,65 @@ class SettingsWidget(QWidget, mainwindow.Ui_Form):
         self.sliderAwbGain.setEnabled(value == "Off")
         self.cam.set_awb_mode(value.lower())
 
+    def _apply_preset(self, name: str):
+        logging.getLogger(__name__).info("Apply preset %s", name)
+        settings = self._presets.get(name)
+        self.cam.set_settings(settings)
+
+        # Show the new values without setting them again one by one
+        widgets = [self.comboboxIso, self.comboboxExposure,
+                   self.comboboxShutterSpeed, self.comboboxAwbMode,
+                   self.sliderAwbGain, self.sliderBrightness,
+                   self.sliderContrast]
+        for widget in widgets:
+            widget.blockSignals(True)
+        if "iso" in settings:
+            self._select(self.comboboxIso, lambda t: int(t) == settings["iso"])
+        if "exposure_mode" in settings:
+            self._select(self.comboboxExposure,
+                         lambda t: t.lower() == settings["exposure_mode"])
+        if settings.get("shutter_speed"):
+            self._select(self.comboboxShutterSpeed,
+                         lambda t: parse_shutter_speed(t)
+                         == settings["shutter_speed"])
+        if "awb_mode" in settings:
+            self._select(self.comboboxAwbMode,
+                         lambda t: t.lower() == settings["awb_mode"])
+            self.sliderAwbGain.setEnabled(settings["awb_mode"] == "off")
+        if "awb_gains" in settings:
+            self.sliderAwbGain.setValue(int(settings["awb_gains"][0] * 10))
+        if "brightness" in settings:
+            self.sliderBrightness.setValue(settings["brightness"])
+        if "contrast" in settings:
+            self.sliderContrast.setValue(settings["contrast"])
+        for widget in widgets:
+            widget.blockSignals(False)
+
+    @staticmethod
+    def _select(combobox, matches):
+        for index in range(combobox.count()):
+            if matches(combobox.itemText(index)):
+                combobox.setCurrentIndex(index)
+                return
+
+    def _save_preset(self):
+        name = self.comboboxPreset.currentText().strip()
+        if not name:
+            return
+        logging.getLogger(__name__).info("Save preset %s", name)
+        self._presets.save(name, self.cam.get_current_settings(PRESET_SETTINGS))
+        if self.comboboxPreset.findText(name) < 0:
+            self.comboboxPreset.clear()
+            self.comboboxPreset.addItems(self._presets.names())
+        self.comboboxPreset.setCurrentIndex(self.comboboxPreset.findText(name))
+
+    def _set_denoise(self, *args):
+        enabled = self.checkboxDenoise.isChecked()
+        self.widgetImgViewer.set_denoise(enabled)
+        self._shutter.set_denoise(
+            self.comboboxDenoiseMode.currentText().lower() if enabled
+            else None)
+
     def _set_led(self, value):
         self.cam.set_led(bool(value))
 
@@ -156,13 +228,60 @@ class SettingsWidget(QWidget, mainwindow.Ui_Form):
         self.btnShutter.setEnabled(False)
         self.btnTogglePreview.setEnabled(False)
         self.widgetImgViewer.buttonFullscreen.setEnabled(False)
-        self._shutter.finished.connect(self._finished_shutter_thread)
         self._shutter.take_picture()
 
     def _finished_shutter_thread(self):
         self.btnShutter.setEnabled(True)
         self.btnTogglePreview.setEnabled(True)
         self.widgetImgViewer.buttonFullscreen.setEnabled(True)
+        if self.btnMotion.isChecked():
+            return
+        self.spinboxTimelapseDelay.setEnabled(True)
+        self.spinboxTimelapseCount.setEnabled(True)
+        self.btnMotion.setEnabled(True)
+        if self.btnTimelapse.isChecked():
+            # The timelapse ended by itself
+            self.btnTimelapse.setChecked(False)
+
+    def toggle_timelapse(self, checked: bool):
+        if not checked:
+            self.btnTimelapse.setText("Start timelapse")
+            self._shutter.stop_timelapse()
+            return
+
+        if self.previewing:
+            self.toggle_preview()
+
+        self.btnShutter.setEnabled(False)
+        self.btnTogglePreview.setEnabled(False)
+        self.widgetImgViewer.buttonFullscreen.setEnabled(False)
+        self.spinboxTimelapseDelay.setEnabled(False)
+        self.spinboxTimelapseCount.setEnabled(False)
+        self.btnMotion.setEnabled(False)
+        self.btnTimelapse.setText("Stop timelapse")
+        self.labelTimelapseStatus.setText("Timelapse started")
+        self._shutter.start_timelapse(self.spinboxTimelapseDelay.value(),
+                                      self.spinboxTimelapseCount.value())
+
+    def _timelapse_progress(self, taken: int):
+        self.labelTimelapseStatus.setText(
+            f"Taken {taken} of {self.spinboxTimelapseCount.value()}")
+
+    def toggle_motion(self, checked: bool):
+        # The preview can keep running, the detector shares its frames
+        self.btnTimelapse.setEnabled(not checked)
+        self.spinboxMotionCount.setEnabled(not checked)
+        if not checked:
+            self.btnMotion.setText("Start motion capture")
+            self._shutter.stop_motion_capture()
+            return
+
+        self.btnMotion.setText("Stop motion capture")
+        self.labelMotionStatus.setText("Waiting for motion")
+        self._shutter.start_motion_capture(self.spinboxMotionCount.value())
+
+    def _motion_detected(self, triggered: int):
+        self.labelMotionStatus.setText(f"Motion detected {triggered} times")
 
     def toggle_preview(self):
         if self.previewing:
@@ -193,6 +312,7 @@ class FullscreenViewer(QWidget):
         self._previewing = False
         self._shutter = shutter
         self._shutter.captured.connect(lambda img: self._display_image(img, CAPTURE_PREVIEW_TIMEOUT))
+        self._shutter.finished.connect(self._shutter_finished)
 
         self._hide_image_timer = QTimer(self)
         self._hide_image_timer.timeout.connect(self._hide_image)
@@ -224,7 +344,6 @@ class FullscreenViewer(QWidget):
         self._buttonStartPreview.setEnabled(False)
         self._buttonShutter.setEnabled(False)
 
-        self._shutter.finished.connect(self._shutter_finished)
         self._shutter.take_picture()
 
     def _shutter_finished(self):
@@ -265,8 +384,115 @@ class FullscreenViewer(QWidget):
         self._hide_image_timer.stop()
 
 
+class GalleryWidget(QWidget):
+    gallery_off = pyqtSignal()
+
+    def __init__(self, storage: Storage, thumbnails: ThumbnailCache,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._storage = storage
+        self._loader = ThumbnailLoader(thumbnails)
+        self._loader.loaded.connect(self._set_thumbnail)
+        self._rows = {}  # image id -> row
+        self._loaded = set()  # rows showing their thumbnail
+        self._placeholder = QIcon()
+
+        self._list = QListWidget()
+        self._list.setViewMode(QListView.IconMode)
+        self._list.setResizeMode(QListView.Adjust)
+        self._list.setMovement(QListView.Static)
+        self._list.setUniformItemSizes(True)
+        self._list.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self._list.setIconSize(QSize(THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 3 // 4))
+        self._list.verticalScrollBar().valueChanged.connect(
+            self._load_visible)
+        self._list.itemClicked.connect(self._show_image)
+        QScroller.grabGesture(self._list.viewport(),
+                              QScroller.LeftMouseButtonGesture)
+
+        self._image = PreviewWidget()
+        self._image.hide()
+
+        self._buttonBack = QPushButton("Back")
+        self._buttonBack.clicked.connect(self._back)
+
+        layout = QVBoxLayout(self)
+        layout.addWidget(self._list)
+        layout.addWidget(self._image)
+        layout.addWidget(self._buttonBack)
+        self.setLayout(layout)
+
+    def refresh(self):
+        # The list comes from the catalog, no image is opened until its
+        # thumbnail is visible
+        self._list.clear()
+        self._rows = {}
+        self._loaded = set()
+        for row, capture in enumerate(self._storage.catalog.captures()):
+            item = QListWidgetItem(self._placeholder, "")
+            item.setData(Qt.UserRole, capture["id"])
+            item.setSizeHint(self._list.iconSize())
+            self._list.addItem(item)
+            self._rows[capture["id"]] = row
+        QTimer.singleShot(0, self._load_visible)
+
+    def _visible_rows(self):
+        viewport = self._list.viewport().rect()
+        first = self._list.indexAt(viewport.topLeft()).row()
+        rows = []
+        row = max(first, 0)
+        while (row < self._list.count() and
+               self._list.visualItemRect(self._list.item(row)).top()
+               < viewport.bottom()):
+            rows.append(row)
+            row += 1
+        return rows
+
+    def _load_visible(self):
+        rows = self._visible_rows()
+        if not rows:
+            return
+
+        # Forget thumbnails far from the view to bound memory use
+        margin = 2 * len(rows)
+        for row in list(self._loaded):
+            if row < rows[0] - margin or row > rows[-1] + margin:
+                self._list.item(row).setIcon(self._placeholder)
+                self._loaded.discard(row)
+
+        self._loader.request(self._list.item(row).data(Qt.UserRole)
+                             for row in rows if row not in self._loaded)
+
+    def _set_thumbnail(self, img_id, image):
+        row = self._rows.get(img_id)
+        if row is None:
+            return
+        self._list.item(row).setIcon(QIcon(QPixmap.fromImage(image)))
+        self._loaded.add(row)
+
+    def _show_image(self, item):
+        filename = self._storage.find(item.data(Qt.UserRole))
+        if filename is None:
+            return
+        self._image.set_image(Image.from_file(filename, reduce=4))
+        self._image.set_info_message(os.path.basename(filename))
+        self._list.hide()
+        self._image.show()
+
+    def _back(self):
+        if self._image.isVisible():
+            self._image.hide()
+            self._image.hide_image()
+            self._list.show()
+        else:
+            self.gallery_off.emit()
+
+    def stop(self):
+        self._loader.close()
+
+
 class Controller(QMainWindow):
-    def __init__(self, cam, shutter):
+    def __init__(self, cam, shutter, thumbnails):
         super().__init__()
 
         # windows
@@ -275,14 +501,21 @@ class Controller(QMainWindow):
         self.full_preview = FullscreenViewer(shutter)
         self.full_preview.set_camera(cam)
 
+        self.gallery = GalleryWidget(shutter.storage, thumbnails)
+
         self.settings.widgetImgViewer.fullscreen_on.connect(
             lambda: self.toggle_fullscreen(True))
         self.full_preview.fullscreen_off.connect(
             lambda: self.toggle_fullscreen(False))
+        self.settings.widgetImgViewer.gallery_on.connect(
+            lambda: self.toggle_gallery(True))
+        self.gallery.gallery_off.connect(
+            lambda: self.toggle_gallery(False))
 
         self.pages = {
             "settings": (self.settings, 0),
-            "preview": (self.full_preview, 1)
+            "preview": (self.full_preview, 1),
+            "gallery": (self.gallery, 2)
         }
 
         self.stack = QStackedWidget(self)
@@ -300,6 +533,15 @@ class Controller(QMainWindow):
             logging.getLogger(__name__).info("Exit fullscreen")
             self.set_page("settings")
 
+    def toggle_gallery(self, value: bool):
+        if value is True:
+            logging.getLogger(__name__).info("Open gallery")
+            self.gallery.refresh()
+            self.set_page("gallery")
+        else:
+            logging.getLogger(__name__).info("Exit gallery")
+            self.set_page("settings")
+
     def set_page(self, name: str):
         widget, idx = self.pages[name]
         logging.getLogger(__name__).debug("Setting page with idx %d", idx)
@@ -330,16 +572,25 @@ def main():
     storage = Storage(IMAGES_DIRECTORY)
     storage.start()
 
+    thumbnails = ThumbnailCache(storage)
+    thumbnails.start()
+
     with Camera() as cam:
-        shutter = img_viewer.Shutter(cam, storage)
+        writer = ImageWriter(on_written=thumbnails.add)
+        shutter = img_viewer.Shutter(cam, storage, writer)
 
         app = QApplication(sys.argv)
         load_stylesheet(app)
-        controller = Controller(cam, shutter)
+        controller = Controller(cam, shutter, thumbnails)
         # controller.showFullScreen()
         controller.show()
         controller.resize(480, 320)
-        sys.exit(app.exec_())
+        exit_code = app.exec_()
+        controller.gallery.stop()
+        shutter.close()
+    thumbnails.stop()
+    storage.close()
+    sys.exit(exit_code)
 
 
 if __name__ == "__main__":
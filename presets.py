@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+
+
+# Settings saved in a preset, see Camera.get_current_settings
+PRESET_SETTINGS = ["framerate", "iso", "exposure_mode", "shutter_speed",
+                   "awb_mode", "awb_gains", "brightness", "contrast"]
+
+DEFAULT_PRESETS = {
+    "Daylight": {
+        "framerate": 30,
+        "iso": 100,
+        "exposure_mode": "auto",
+        "shutter_speed": 0,
+        "awb_mode": "sunlight",
+        "brightness": 50,
+        "contrast": 0,
+    },
+    "Night": {
+        "framerate": 1,
+        # Not "off": the gains would freeze before reaching ISO 800
+        "iso": 800,
+        "exposure_mode": "auto",
+        "shutter_speed": 1000000,
+        "awb_mode": "auto",
+        "brightness": 50,
+        "contrast": 0,
+    },
+}
+
+
+class Presets:
+    # Named sets of camera settings, saved as JSON
+    def __init__(self, filename):
+        self.filename = filename
+        self._presets = {}
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self._presets = json.load(f)
+        except FileNotFoundError:
+            self._presets = dict(DEFAULT_PRESETS)
+        except ValueError:
+            logging.getLogger(__name__).warning(
+                "Invalid presets file %s, using the default presets",
+                self.filename)
+            self._presets = dict(DEFAULT_PRESETS)
+
+    def names(self):
+        return sorted(self._presets)
+
+    def get(self, name: str) -> dict:
+        return dict(self._presets[name])
+
+    def save(self, name: str, settings: dict):
+        self._presets[name] = {k: v for k, v in settings.items()
+                               if k in PRESET_SETTINGS}
+        self._write()
+
+    def delete(self, name: str):
+        del self._presets[name]
+        self._write()
+
+    def _write(self):
+        temporary = self.filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self._presets, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.filename)
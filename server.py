@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os.path
+import re
+import urllib.parse
+from http import HTTPStatus
+
+from camera import BRACKET_STOPS, Camera, REAL_CAMERA
+from capture import Capturer
+from presets import PRESET_SETTINGS, Presets
+from stack import STACK_MODES
+from storage import Storage, VALID_FILE_EXTENSIONS
+from streaming import MJPEG_BOUNDARY, MjpegStream
+from thumbnails import ThumbnailCache
+from timelapse import Timelapse
+from writer import ImageWriter
+
+
+BASE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+IMAGES_DIRECTORY = os.path.join(BASE_DIRECTORY, "images")
+PRESETS_FILE = os.path.join(BASE_DIRECTORY, "presets.json")
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+MAX_BODY_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Most pictures a single capture request may take, like the GUI's bursts
+MAX_CAPTURE_COUNT = 100
+
+CONTENT_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: HTTPStatus, message: str = None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class Response:
+    # body is bytes, or an async iterator of bytes for streamed responses
+    def __init__(self, body=b"", status: HTTPStatus = HTTPStatus.OK,
+                 content_type: str = "application/json", headers=None):
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = headers or {}
+
+    @staticmethod
+    def json(value, status: HTTPStatus = HTTPStatus.OK):
+        return Response(json.dumps(value).encode(), status)
+
+
+class CameraServer:
+    # HTTP/JSON API to the camera, without Qt.
+    #
+    # Captures run one at a time on a single capture thread, whichever
+    # client asked for them. A running timelapse keeps that thread busy, so
+    # captures are refused until it is stopped.
+    def __init__(self, camera, storage, writer, thumbnails, presets):
+        self.camera = camera
+        self.storage = storage
+        self.thumbnails = thumbnails
+        self.presets = presets
+        self.capture_format = "jpeg"
+        self._capturer = Capturer(camera, storage, writer)
+        self._capture_thread = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="Capture")
+        self._timelapse = None
+        self.stream = MjpegStream(camera)
+        self._routes = [
+            ("GET", r"/status", self._get_status),
+            ("GET", r"/settings", self._get_settings),
+            ("POST", r"/settings", self._post_settings),
+            ("GET", r"/presets", self._get_presets),
+            ("POST", r"/presets/(?P<name>[^/]+)", self._post_preset),
+            ("PUT", r"/presets/(?P<name>[^/]+)", self._put_preset),
+            ("DELETE", r"/presets/(?P<name>[^/]+)", self._delete_preset),
+            ("POST", r"/capture", self._post_capture),
+            ("POST", r"/bracket", self._post_bracket),
+            ("GET", r"/groups/(?P<group_id>\d+)", self._get_group),
+            ("GET", r"/timelapse", self._get_timelapse),
+            ("POST", r"/timelapse", self._post_timelapse),
+            ("DELETE", r"/timelapse", self._delete_timelapse),
+            ("GET", r"/images", self._get_images),
+            ("GET", r"/images/(?P<img_id>\d+)", self._get_image),
+            ("GET", r"/images/(?P<img_id>\d+)/thumbnail",
+             self._get_thumbnail),
+            ("GET", r"/stream\.mjpg", self._get_stream),
+        ]
+
+    def add_route(self, method: str, pattern: str, handler):
+        # handler(query, body, **groups) is a coroutine returning a Response
+        self._routes.append((method, pattern, handler))
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        server = await asyncio.start_server(self._handle, host, port)
+        logging.getLogger(__name__).info("Listening on %s:%d", host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self._stop_timelapse()
+        self.stream.close()
+        self._capture_thread.shutdown()
+
+    async def _run_capture(self, action, *args):
+        if self._timelapse_running():
+            raise HttpError(HTTPStatus.CONFLICT, "A timelapse is running")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._capture_thread, action, *args)
+
+    # HTTP
+
+    async def _handle(self, reader, writer):
+        try:
+            response = await self._respond(reader)
+        except HttpError as e:
+            response = Response.json({"error": str(e)}, e.status)
+        except Exception:
+            logging.getLogger(__name__).exception("Error handling request")
+            response = Response.json({"error": "Internal error"},
+                                     HTTPStatus.INTERNAL_SERVER_ERROR)
+
+        try:
+            await self._send(writer, response)
+        except ConnectionError:
+            pass
+        except Exception:
+            # e.g. a streamed body failing, the headers are already sent
+            logging.getLogger(__name__).exception("Error sending response")
+        finally:
+            writer.close()
+
+    async def _respond(self, reader):
+        request_line = await reader.readline()
+        try:
+            method, target, _ = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        allowed = False
+        for route_method, pattern, handler in self._routes:
+            match = re.fullmatch(pattern, url.path)
+            if match is None:
+                continue
+            allowed = True
+            if route_method == method:
+                logging.getLogger(__name__).debug("%s %s", method, target)
+                return await handler(query, body, **match.groupdict())
+        if allowed:
+            raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
+        raise HttpError(HTTPStatus.NOT_FOUND)
+
+    async def _send(self, writer, response):
+        headers = {"Content-Type": response.content_type,
+                   "Connection": "close", **response.headers}
+        if isinstance(response.body, bytes):
+            headers["Content-Length"] = str(len(response.body))
+        head = f"HTTP/1.1 {response.status.value} {response.status.phrase}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        writer.write((head + "\r\n").encode("latin-1"))
+
+        if isinstance(response.body, bytes):
+            writer.write(response.body)
+            await writer.drain()
+        else:
+            try:
+                async for chunk in response.body:
+                    writer.write(chunk)
+                    await writer.drain()
+            finally:
+                # Also when the client went away, e.g. to end a stream
+                await response.body.aclose()
+
+    @staticmethod
+    def _json_body(body):
+        try:
+            value = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid JSON")
+        if not isinstance(value, dict):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Expected a JSON object")
+        return value
+
+    # Handlers
+
+    async def _get_status(self, query, body):
+        return Response.json({
+            "real_camera": REAL_CAMERA,
+            "resolution": self.camera.get_resolution(),
+            "capture_format": self.capture_format,
+            "images": self.storage.catalog.count(),
+            "timelapse": self._timelapse_status(),
+        })
+
+    async def _get_settings(self, query, body):
+        return Response.json(self.camera.get_current_settings(
+            PRESET_SETTINGS + ["led"]))
+
+    async def _post_settings(self, query, body):
+        settings = self._json_body(body)
+        image_format = settings.pop("capture_format", None)
+        if image_format is not None:
+            if image_format not in VALID_FILE_EXTENSIONS:
+                raise HttpError(HTTPStatus.BAD_REQUEST,
+                                f"Invalid format {image_format}")
+            self.capture_format = image_format
+        try:
+            self.camera.set_settings(settings)
+        except ValueError as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        return await self._get_settings(query, b"")
+
+    async def _get_presets(self, query, body):
+        return Response.json({name: self.presets.get(name)
+                              for name in self.presets.names()})
+
+    async def _post_preset(self, query, body, name):
+        # Applies the preset
+        name = urllib.parse.unquote(name)
+        if name not in self.presets.names():
+            raise HttpError(HTTPStatus.NOT_FOUND, f"No preset {name}")
+        self.camera.set_settings(self.presets.get(name))
+        return await self._get_settings(query, b"")
+
+    async def _put_preset(self, query, body, name):
+        # Creates or replaces the preset, with the settings in the body or
+        # else the current ones
+        name = urllib.parse.unquote(name).strip()
+        if not name:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid name")
+        settings = (self._json_body(body)
+                    or self.camera.get_current_settings(PRESET_SETTINGS))
+        invalid = [k for k in settings if k not in PRESET_SETTINGS]
+        if invalid:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            f"Invalid settings {', '.join(invalid)}")
+        self.presets.save(name, settings)
+        return Response.json(self.presets.get(name))
+
+    async def _delete_preset(self, query, body, name):
+        name = urllib.parse.unquote(name)
+        if name not in self.presets.names():
+            raise HttpError(HTTPStatus.NOT_FOUND, f"No preset {name}")
+        self.presets.delete(name)
+        return Response.json(None)
+
+    async def _post_capture(self, query, body):
+        request = self._json_body(body)
+        try:
+            count = int(request.get("count", 1))
+        except (TypeError, ValueError):
+            count = 0
+        if not 1 <= count <= MAX_CAPTURE_COUNT:
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            f"Count must be from 1 to {MAX_CAPTURE_COUNT}")
+        stack = request.get("stack")
+        if stack is not None and stack not in STACK_MODES:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"Invalid stack {stack}")
+        if self._timelapse_running():
+            raise HttpError(HTTPStatus.CONFLICT, "A timelapse is running")
+        if stack is not None:
+            # count frames averaged into a single picture
+            filename = self.storage.get_new_name(self.capture_format)
+            await self._run_capture(self._capturer.take_stack, filename,
+                                    count)
+            return Response.json({"images": [self.storage.get_id(filename)]},
+                                 HTTPStatus.CREATED)
+        filenames = self.storage.get_new_names(self.capture_format, count)
+        if count == 1:
+            await self._run_capture(self._capturer.take_picture, filenames[0])
+        else:
+            await self._run_capture(self._capturer.take_burst, filenames)
+        return Response.json({"images": [self.storage.get_id(f)
+                                         for f in filenames]},
+                             HTTPStatus.CREATED)
+
+    async def _post_bracket(self, query, body):
+        request = self._json_body(body)
+        stops = request.get("stops", BRACKET_STOPS)
+        if (not isinstance(stops, list)
+                or not 1 <= len(stops) < MAX_CAPTURE_COUNT
+                or not all(isinstance(ev, (int, float)) for ev in stops)):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid stops")
+        hdr = bool(request.get("hdr", False))
+        if self._timelapse_running():
+            raise HttpError(HTTPStatus.CONFLICT, "A timelapse is running")
+        filenames = self.storage.get_new_names(self.capture_format,
+                                               len(stops) + hdr)
+        hdr_filename = filenames.pop() if hdr else None
+        await self._run_capture(self._capturer.take_bracket, filenames, stops,
+                                hdr_filename)
+        group_id = self.storage.get_id(filenames[0])
+        return Response.json(self.storage.catalog.group(group_id),
+                             HTTPStatus.CREATED)
+
+    async def _get_group(self, query, body, group_id):
+        group = self.storage.catalog.group(int(group_id))
+        if group is None:
+            raise HttpError(HTTPStatus.NOT_FOUND)
+        return Response.json(group)
+
+    def _timelapse_running(self):
+        return self._timelapse is not None and not self._timelapse.is_stopped()
+
+    def _timelapse_status(self):
+        if not self._timelapse_running():
+            return None
+        return {"interval": self._timelapse.interval,
+                "count": self._timelapse.count,
+                "taken": self._timelapse.taken}
+
+    async def _get_timelapse(self, query, body):
+        return Response.json(self._timelapse_status())
+
+    async def _post_timelapse(self, query, body):
+        request = self._json_body(body)
+        try:
+            interval = float(request["interval"])
+            count = request.get("count")
+            count = int(count) if count is not None else None
+        except (KeyError, TypeError, ValueError):
+            raise HttpError(HTTPStatus.BAD_REQUEST,
+                            "Expected an interval and an optional count")
+        image_format = self.capture_format
+
+        def capture(index):
+            self._capturer.take_picture(
+                self.storage.get_new_name(image_format))
+
+        try:
+            timelapse = Timelapse(capture, interval, count)
+        except ValueError as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        if self._timelapse_running():
+            raise HttpError(HTTPStatus.CONFLICT, "A timelapse is running")
+
+        # Not awaited: the capture thread is busy until it ends
+        self._capture_thread.submit(self._run_timelapse, timelapse)
+        self._timelapse = timelapse
+        return Response.json(self._timelapse_status(), HTTPStatus.CREATED)
+
+    def _run_timelapse(self, timelapse):
+        try:
+            self._capturer.run_timelapse(timelapse)
+        except Exception:
+            logging.getLogger(__name__).exception("Timelapse failed")
+        finally:
+            timelapse.stop()
+
+    def _stop_timelapse(self):
+        if self._timelapse is not None:
+            self._timelapse.stop()
+
+    async def _delete_timelapse(self, query, body):
+        self._stop_timelapse()
+        return Response.json(None)
+
+    async def _get_images(self, query, body):
+        filters = dict(query)
+        try:
+            for name in ("limit", "offset"):
+                if name in filters:
+                    filters[name] = int(filters[name])
+            for name in ("since", "until"):
+                if name in filters:
+                    filters[name] = float(filters[name])
+            captures = self.storage.catalog.captures(**filters)
+        except ValueError as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, str(e))
+        return Response.json(captures)
+
+    async def _get_image(self, query, body, img_id):
+        filename = self.storage.find(int(img_id))
+        if filename is None:
+            raise HttpError(HTTPStatus.NOT_FOUND)
+        extension = os.path.splitext(filename)[1][1:]
+
+        async def chunks():
+            loop = asyncio.get_running_loop()
+            with open(filename, "rb") as f:
+                while True:
+                    chunk = await loop.run_in_executor(
+                        None, f.read, DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        disposition = f'attachment; filename="{os.path.basename(filename)}"'
+        return Response(chunks(),
+                        content_type=CONTENT_TYPES.get(
+                            extension, "application/octet-stream"),
+                        headers={
+                            "Content-Length": str(os.path.getsize(filename)),
+                            "Content-Disposition": disposition,
+                        })
+
+    async def _get_thumbnail(self, query, body, img_id):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.thumbnails.get,
+                                          int(img_id))
+        if data is None:
+            raise HttpError(HTTPStatus.NOT_FOUND)
+        return Response(data, content_type="image/jpeg")
+
+    async def _get_stream(self, query, body):
+        frames = self.stream.frames()
+
+        async def parts():
+            try:
+                async for frame in frames:
+                    yield (f"--{MJPEG_BOUNDARY}\r\n"
+                           "Content-Type: image/jpeg\r\n"
+                           f"Content-Length: {len(frame)}\r\n\r\n"
+                           ).encode() + frame + b"\r\n"
+            finally:
+                await frames.aclose()
+
+        return Response(parts(),
+                        content_type="multipart/x-mixed-replace; "
+                                     f"boundary={MJPEG_BOUNDARY}",
+                        headers={"Cache-Control": "no-cache, private"})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the camera without GUI, controlled over HTTP")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--images", default=IMAGES_DIRECTORY)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    storage = Storage(args.images)
+    storage.start()
+    thumbnails = ThumbnailCache(storage)
+    thumbnails.start()
+    presets = Presets(PRESETS_FILE)
+    presets.load()
+    writer = ImageWriter(on_written=thumbnails.add)
+    writer.start()
+
+    with Camera() as cam:
+        server = CameraServer(cam, storage, writer, thumbnails, presets)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+
+    writer.stop()
+    thumbnails.stop()
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
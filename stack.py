@@ -0,0 +1,163 @@
+import logging
+import math
+
+import cv2
+import numpy as np
+
+
+STACK_AVERAGE = "average"  # same exposure, averaged to cut noise
+# Fusing frames of the same exposure does not extend the dynamic range, HDR
+# pictures are fused from brackets instead, see Capturer.take_bracket
+STACK_MODES = [STACK_AVERAGE]
+
+# Alignment is estimated on grayscale frames downscaled to this width
+ALIGN_WIDTH = 640
+ALIGN_ITERATIONS = 50
+ALIGN_EPSILON = 1e-4
+
+
+class FrameAligner:
+    # Aligns frames on the first one with ECC, which copes with the
+    # brightness differences of bracketed exposures. Euclidean motion (shift
+    # and rotation) is what a camera on a stand moves between frames.
+    def __init__(self, width: int = ALIGN_WIDTH,
+                 motion: int = cv2.MOTION_EUCLIDEAN):
+        self.width = width
+        self.motion = motion
+        self._reference = None
+        self._gray = None
+        self._warp = np.eye(2, 3, dtype=np.float32)
+
+    def _downscale(self, array):
+        height, width = array.shape[:2]
+        scale = min(self.width / width, 1)
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        if self._gray is None:
+            self._small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            self._gray = np.empty((size[1], size[0]), dtype=np.uint8)
+        cv2.resize(array, size, dst=self._small,
+                   interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        return scale
+
+    def align(self, array):
+        # Returns the frame aligned on the first one, or as is if the
+        # alignment does not converge
+        scale = self._downscale(array)
+        if self._reference is None:
+            self._reference = self._gray.copy()
+            return array
+
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                    ALIGN_ITERATIONS, ALIGN_EPSILON)
+        try:
+            # Starts from the previous frame's warp, frames drift slowly
+            _, self._warp = cv2.findTransformECC(
+                self._reference, self._gray, self._warp, self.motion,
+                criteria, None, 5)
+        except cv2.error:
+            logging.getLogger(__name__).warning("Could not align frame")
+            return array
+
+        warp = self._warp.copy()
+        warp[:, 2] /= scale
+        height, width = array.shape[:2]
+        return cv2.warpAffine(array, warp, (width, height),
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+
+class AverageStacker:
+    passes = 1
+
+    def __init__(self):
+        self._sum = None
+        self.count = 0
+
+    def add(self, array, pass_index: int = 0):
+        if self._sum is None:
+            self._sum = np.zeros(array.shape, dtype=np.float32)
+        cv2.add(self._sum, array, dst=self._sum, dtype=cv2.CV_32F)
+        self.count += 1
+
+    def result(self):
+        return cv2.convertScaleAbs(self._sum, alpha=1 / self.count)
+
+
+class MertensStacker:
+    # Exposure fusion like cv2.createMergeMertens, but frames are added one
+    # at a time instead of all being kept in memory.
+    #
+    # The blending weights of a pixel are normalised over all the frames, so
+    # the frames are added twice: the first pass sums the weights, the
+    # second blends the frames' Laplacian pyramids into an accumulator.
+    passes = 2
+
+    def __init__(self, contrast_weight: float = 1.0,
+                 saturation_weight: float = 1.0,
+                 exposure_weight: float = 0.0):
+        self.contrast_weight = contrast_weight
+        self.saturation_weight = saturation_weight
+        self.exposure_weight = exposure_weight
+        self._weight_sum = None
+        self._levels = None
+        self._blended = None
+        self.count = 0
+
+    def _weight(self, image):
+        weight = np.ones(image.shape[:2], dtype=np.float32)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.contrast_weight:
+            contrast = np.abs(cv2.Laplacian(gray, cv2.CV_32F))
+            weight *= contrast ** self.contrast_weight
+        if self.saturation_weight:
+            saturation = image.std(axis=2)
+            weight *= saturation ** self.saturation_weight
+        if self.exposure_weight:
+            exposedness = np.exp(-((image - 0.5) ** 2) / (2 * 0.2 ** 2))
+            weight *= exposedness.prod(axis=2) ** self.exposure_weight
+        return weight + 1e-12
+
+    def add(self, array, pass_index: int = 0):
+        image = array.astype(np.float32) / 255
+        weight = self._weight(image)
+        if pass_index == 0:
+            if self._weight_sum is None:
+                self._weight_sum = weight
+            else:
+                self._weight_sum += weight
+            return
+
+        weight /= self._weight_sum
+        if self._levels is None:
+            height, width = image.shape[:2]
+            self._levels = int(math.log2(min(height, width)))
+            self._blended = [None] * (self._levels + 1)
+
+        weights = [weight]
+        gaussian = [image]
+        for _ in range(self._levels):
+            weights.append(cv2.pyrDown(weights[-1]))
+            gaussian.append(cv2.pyrDown(gaussian[-1]))
+        del image, weight
+
+        for level in range(self._levels + 1):
+            if level < self._levels:
+                size = gaussian[level].shape[1::-1]
+                # Laplacian level, computed in place of the Gaussian one
+                gaussian[level] -= cv2.pyrUp(gaussian[level + 1],
+                                             dstsize=size)
+            weighted = gaussian[level] * weights[level][..., None]
+            if self._blended[level] is None:
+                self._blended[level] = weighted
+            else:
+                self._blended[level] += weighted
+        self.count += 1
+
+    def result(self):
+        image = self._blended[-1]
+        for level in range(self._levels - 1, -1, -1):
+            size = self._blended[level].shape[1::-1]
+            image = cv2.pyrUp(image, dstsize=size)
+            image += self._blended[level]
+        return cv2.convertScaleAbs(np.clip(image, 0, 1), alpha=255)
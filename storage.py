@@ -1,45 +1,255 @@
+import bisect
+import contextlib
+import fcntl
 import logging
 import os
 import os.path
 import re
+import threading
+import time
+
+from catalog import Catalog
 
 
 VALID_FILE_EXTENSIONS = ["jpeg", "png", "gif", "bmp", "yuv", "rgb", "rgba"]
+# Keeps the next image id and the shards, so the directories do not have to
+# be scanned on every start
+INDEX_FILE = ".picam_index"
+CATALOG_FILE = ".picam_catalog.sqlite"
+
+# How images are spread in subdirectories (shards) of the storage path
+LAYOUT_FLAT = "flat"  # all in the same directory
+LAYOUT_DATE = "date"  # one directory per day: YYYY/MM/DD
+LAYOUT_ID = "id"  # one directory per ID_SHARD_SIZE ids: NNNN
+LAYOUTS = [LAYOUT_FLAT, LAYOUT_DATE, LAYOUT_ID]
+ID_SHARD_SIZE = 1000
+# Digits of the image ids in the names of a new storage. Names must all have
+# the same width to be listed in order, this one is enough for a lifetime of
+# shots. Existing storages keep the width of their names.
+DEFAULT_NUM_DIGITS = 8
+
+_SHARD_REGEX = {
+    LAYOUT_FLAT: re.compile(r""),
+    LAYOUT_DATE: re.compile(r"\d{4}/\d{2}/\d{2}"),
+    LAYOUT_ID: re.compile(r"\d+"),
+}
+_IMG_REGEX = re.compile(r"IMG(\d+)\.(" + "|".join(VALID_FILE_EXTENSIONS) + ")")
 
 
 class Storage:
-    def __init__(self, path, num_digits: int = 4):
+    def __init__(self, path, num_digits: int = None,
+                 layout: str = LAYOUT_FLAT):
+        if layout not in LAYOUTS:
+            raise Exception(f"Invalid layout {layout}")
         self.path = path
         self._next_id = None
+        # None until known from the index or the existing names
         self._num_digits = num_digits
+        self._layout = layout
+        # (first id, shard) of every shard, sorted by id
+        self._shards = []
+        self._index_path = os.path.join(path, INDEX_FILE)
+        # Names are handed out under both locks: the thread lock for this
+        # process and the lock file for other processes using the same path
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self.catalog = None
 
     def start(self):
         os.makedirs(self.path, exist_ok=True)
-        self._set_next_img_id()
+        self._lock_file = open(self._index_path + ".lock", "a")
+        with self._locked():
+            self._set_next_img_id()
+        self.catalog = Catalog(os.path.join(self.path, CATALOG_FILE))
+
+    def close(self):
+        self.catalog.close()
+        self.catalog = None
+        self._lock_file.close()
+        self._lock_file = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
 
     def _set_next_img_id(self):
         logger = logging.getLogger(__name__)
-        self._next_id = 0
-        files = [f for f in os.listdir(self.path)
-                 if os.path.isfile(os.path.join(self.path, f))]
-        extensions_match = "(" + "|".join(VALID_FILE_EXTENSIONS) + ")"
-        img_regex = re.compile(r"IMG(\d+)\." + extensions_match)
-        for f in files:
-            if img_regex.match(f):
-                img_id = int(img_regex.match(f).group(1))
-                self._next_id = max(self._next_id, img_id + 1)
+        if not self._read_index():
+            logger.info("Storage index is missing or outdated, scanning %s",
+                        self.path)
+            self._scan()
+            self._write_index()
 
         if self._next_id != 0:
             logger.info("Storage has found existing images, starting at id"
                         " %d", self._next_id)
         else:
             logger.info("Storage has not found any image. Starting at id 0")
+        if self._next_id >= 10 ** self._num_digits:
+            logger.warning("Image ids do not fit in %d digits anymore, names"
+                           " will not be listed in order", self._num_digits)
+
+    def _load_index(self) -> bool:
+        # Returns whether the index could be loaded
+        try:
+            with open(self._index_path) as f:
+                layout, next_id, num_digits = f.readline().split()
+                next_id = int(next_id)
+                num_digits = int(num_digits)
+                shards = [(int(first_id), shard) for first_id, shard
+                          in (line.split() for line in f)]
+        except (OSError, ValueError):
+            return False
+        if layout != self._layout or next_id < 0:
+            return False
+        if self._num_digits not in (None, num_digits):
+            return False
+
+        self._num_digits = num_digits
+        self._next_id = next_id
+        self._shards = shards
+        return True
+
+    def _read_index(self) -> bool:
+        # Returns whether the index could be loaded and is up to date
+        if not self._load_index():
+            return False
+
+        # Every name is written to the index before being used, so an
+        # existing image with the next id means the index is outdated
+        candidates = {self._new_shard(self._next_id)}
+        if self._shards:
+            candidates.add(self._shards[-1][1])
+        for shard in candidates:
+            if self._find_in_shard(shard, self._next_id) is not None:
+                return False
+        return True
+
+    def _write_index(self):
+        temporary = self._index_path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(f"{self._layout} {self._next_id} {self._num_digits}\n")
+            for first_id, shard in self._shards:
+                f.write(f"{first_id} {shard}\n")
+        os.replace(temporary, self._index_path)
+
+    def _shard_directories(self):
+        # All the existing shards, sorted
+        if self._layout == LAYOUT_FLAT:
+            return [""]
+        depth = 3 if self._layout == LAYOUT_DATE else 1
+        shards = [""]
+        for _ in range(depth):
+            shards = [os.path.join(shard, entry.name) for shard in shards
+                      for entry in os.scandir(os.path.join(self.path, shard))
+                      if entry.is_dir() and entry.name.isdigit()]
+        return sorted(s for s in shards
+                      if _SHARD_REGEX[self._layout].fullmatch(s))
+
+    def _scan(self):
+        self._next_id = 0
+        self._shards = []
+        # Width of the existing names, the shortest is the padded one
+        widths = set()
+        for shard in self._shard_directories():
+            ids = []
+            with os.scandir(os.path.join(self.path, shard)) as entries:
+                for entry in entries:
+                    match = _IMG_REGEX.match(entry.name)
+                    if match and entry.is_file():
+                        ids.append(int(match.group(1)))
+                        widths.add(len(match.group(1)))
+            if ids:
+                if self._layout != LAYOUT_FLAT:
+                    self._shards.append((min(ids), shard))
+                self._next_id = max(self._next_id, max(ids) + 1)
+        if self._num_digits is None:
+            self._num_digits = min(widths, default=DEFAULT_NUM_DIGITS)
+
+    def _new_shard(self, img_id):
+        # Shard where a new image with this id goes
+        if self._layout == LAYOUT_DATE:
+            return time.strftime("%Y/%m/%d")
+        elif self._layout == LAYOUT_ID:
+            return f"{img_id // ID_SHARD_SIZE:04}"
+        return ""
+
+    def _name(self, shard, img_id, extension):
+        img_name = f"IMG{img_id:0{self._num_digits}}.{extension}"
+        return os.path.join(self.path, shard, img_name)
+
+    def _find_in_shard(self, shard, img_id):
+        for extension in VALID_FILE_EXTENSIONS:
+            name = self._name(shard, img_id, extension)
+            if os.path.exists(name):
+                return name
+        return None
+
+    def find(self, img_id: int):
+        # Returns the path of the image with this id, or None. Only the
+        # shard that can contain it is looked at.
+        if self._layout == LAYOUT_FLAT:
+            return self._find_in_shard("", img_id)
+        elif self._layout == LAYOUT_ID:
+            return self._find_in_shard(self._new_shard(img_id), img_id)
+
+        position = bisect.bisect_right([first for first, _ in self._shards],
+                                       img_id)
+        if position == 0:
+            return None
+        return self._find_in_shard(self._shards[position - 1][1], img_id)
+
+    def add_capture(self, filename: str, captured_at: float, size: int,
+                    resolution, settings: dict, thumbnail: bytes = None,
+                    group_id: int = None):
+        # Records a capture in the catalog
+        name = os.path.relpath(filename, self.path)
+        extension = os.path.splitext(filename)[1][1:]
+        width, height = resolution
+        self.catalog.add(self.get_id(filename), name, captured_at, size,
+                         width, height, extension, settings, thumbnail,
+                         group_id)
+
+    def add_group(self, kind: str, filenames) -> int:
+        # Records that the images of filenames (reserved with get_new_names)
+        # belong together. Returns the group id, to pass to add_capture.
+        group_id = self.get_id(filenames[0])
+        self.catalog.add_group(group_id, kind, time.time())
+        return group_id
+
+    @staticmethod
+    def get_id(filename: str) -> int:
+        match = _IMG_REGEX.match(os.path.basename(filename))
+        if match is None:
+            raise Exception(f"Not a storage image {filename}")
+        return int(match.group(1))
 
     def get_new_name(self, extension):
+        return self.get_new_names(extension, 1)[0]
+
+    def get_new_names(self, extension, count: int):
+        # Reserves count consecutive names at once, which is cheaper than
+        # asking for them one by one
         if extension not in VALID_FILE_EXTENSIONS:
             raise Exception(f"Invalid extension {extension}")
-        img_name = f"IMG{self._next_id:0{self._num_digits}}.{extension}"
-        self._next_id += 1
-        return os.path.join(self.path, img_name)
-
 
+        names = []
+        with self._locked():
+            # Another process may have handed out names since we last did
+            self._load_index()
+            for _ in range(count):
+                img_id = self._next_id
+                shard = self._new_shard(img_id)
+                if self._layout != LAYOUT_FLAT and (
+                        not self._shards or self._shards[-1][1] != shard):
+                    os.makedirs(os.path.join(self.path, shard), exist_ok=True)
+                    self._shards.append((img_id, shard))
+                self._next_id += 1
+                names.append(self._name(shard, img_id, extension))
+            self._write_index()
+        return names
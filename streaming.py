@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+
+
+MJPEG_BOUNDARY = "frame"
+DEFAULT_STREAM_RESOLUTION = (640, 480)
+# Bytes per second each client may receive
+DEFAULT_BANDWIDTH = 4000000 // 8
+ADAPT_INTERVAL = 2.0
+# The stream is only made more expensive again when it uses less than this
+# fraction of the budget, so it does not bounce between two levels
+ADAPT_HEADROOM = 0.5
+
+# (scale, JPEG quality) from the most to the least expensive. Quality is
+# lowered first, resolution when lower quality would look too bad.
+STREAM_LEVELS = [(1, 80), (1, 65), (1, 50),
+                 (0.75, 50), (0.75, 35),
+                 (0.5, 50), (0.5, 35),
+                 (0.25, 50), (0.25, 35)]
+
+
+class MjpegStream:
+    # Live JPEG frames for any number of clients.
+    #
+    # The camera encodes each frame once, whatever the number of clients,
+    # and only the newest frame is kept: a client slower than the camera
+    # skips frames instead of queueing them. The camera only encodes while
+    # there are clients.
+    def __init__(self, camera, resolution=DEFAULT_STREAM_RESOLUTION,
+                 bandwidth: int = DEFAULT_BANDWIDTH):
+        self._camera = camera
+        self._resolution = resolution
+        self.bandwidth = bandwidth
+        self._level = 0
+
+        self._loop = None
+        self._buffer = bytearray()
+        self._frame = None
+        self._frame_id = 0
+        self._frame_ready = None
+        self._clients = 0
+        self._encoding = False
+        self._start_lock = None
+        self._adapt_task = None
+        self._measured_since = 0
+        self._measured_bytes = 0
+
+    @property
+    def clients(self) -> int:
+        return self._clients
+
+    @property
+    def quality(self) -> int:
+        return STREAM_LEVELS[self._level][1]
+
+    @property
+    def resolution(self):
+        scale = STREAM_LEVELS[self._level][0]
+        width, height = self._resolution
+        # The GPU resizer wants widths multiple of 32 and heights of 16
+        return (max(32, int(width * scale) // 32 * 32),
+                max(16, int(height * scale) // 16 * 16))
+
+    # Camera output, called from the encoder thread
+
+    def write(self, data):
+        self._buffer += data
+        # A frame may come in several writes, it is complete at the JPEG
+        # end of image marker
+        if self._buffer.endswith(b"\xff\xd9"):
+            frame = bytes(self._buffer)
+            self._buffer.clear()
+            try:
+                self._loop.call_soon_threadsafe(self._publish, frame)
+            except RuntimeError:
+                pass  # the event loop is closed, nobody is listening
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Event loop side
+
+    def _publish(self, frame):
+        self._frame = frame
+        self._frame_id += 1
+        self._measured_bytes += len(frame)
+        ready, self._frame_ready = self._frame_ready, asyncio.Event()
+        ready.set()
+
+    async def frames(self):
+        # Yields the newest frame each time there is one the client has not
+        # seen. Must be closed with aclose so the encoder stops.
+        added = False
+        try:
+            await self._add_client()
+            added = True
+            last_id = self._frame_id
+            while True:
+                if self._frame_id == last_id:
+                    await self._frame_ready.wait()
+                last_id = self._frame_id
+                yield self._frame
+        finally:
+            if added:
+                await self._remove_client()
+
+    async def _add_client(self):
+        if self._start_lock is None:
+            self._loop = asyncio.get_running_loop()
+            self._start_lock = asyncio.Lock()
+            self._frame_ready = asyncio.Event()
+        async with self._start_lock:
+            if not self._encoding:
+                await self._loop.run_in_executor(None, self._start)
+                self._adapt_task = self._loop.create_task(self._adapt())
+            # Only counted once the encoder runs, a client that could not
+            # start it is not removed
+            self._clients += 1
+
+    async def _remove_client(self):
+        async with self._start_lock:
+            self._clients -= 1
+            if self._clients == 0 and self._encoding:
+                self._adapt_task.cancel()
+                self._adapt_task = None
+                await self._loop.run_in_executor(None, self._stop)
+
+    def _start(self):
+        logging.getLogger(__name__).debug(
+            "Start MJPEG stream at %s, quality %d", self.resolution,
+            self.quality)
+        self._buffer.clear()
+        self._camera.start_mjpeg(self, self.resolution, self.quality)
+        self._encoding = True
+        self._measured_since = time.monotonic()
+        self._measured_bytes = 0
+
+    def _stop(self):
+        self._encoding = False
+        self._camera.stop_mjpeg()
+
+    def close(self):
+        if self._encoding:
+            self._stop()
+
+    async def _adapt(self):
+        # Changing the quality or resolution restarts the encoder, so it is
+        # done at most once per ADAPT_INTERVAL
+        while True:
+            await asyncio.sleep(ADAPT_INTERVAL)
+            now = time.monotonic()
+            rate = self._measured_bytes / (now - self._measured_since)
+            self._measured_since = now
+            self._measured_bytes = 0
+            level = self._level
+            if rate > self.bandwidth and level < len(STREAM_LEVELS) - 1:
+                level += 1
+            elif rate < self.bandwidth * ADAPT_HEADROOM and level > 0:
+                level -= 1
+            if level == self._level:
+                continue
+            logging.getLogger(__name__).debug(
+                "MJPEG stream uses %d B/s of %d", rate, self.bandwidth)
+            async with self._start_lock:
+                if not self._encoding:
+                    return
+                self._level = level
+                await self._loop.run_in_executor(None, self._stop)
+                await self._loop.run_in_executor(None, self._start)
@@ -0,0 +1,131 @@
+import collections
+import logging
+import os
+import os.path
+import queue
+import threading
+
+import cv2
+
+from catalog import THUMBNAIL_WIDTH, make_thumbnail
+
+
+THUMBNAILS_DIRECTORY = ".thumbnails"
+DEFAULT_CACHE_BUDGET = 32 * 1024 * 1024
+
+
+class ThumbnailCache:
+    # Gallery thumbnails stored as small JPEG files under the storage path.
+    #
+    # Thumbnails are generated in the background as soon as an image is
+    # written (see add), or on demand for older images. The least recently
+    # used ones are removed once the cache is over budget bytes.
+    def __init__(self, storage, budget: int = DEFAULT_CACHE_BUDGET):
+        self.storage = storage
+        self.budget = budget
+        self.path = os.path.join(storage.path, THUMBNAILS_DIRECTORY)
+        # img id -> size, least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        with os.scandir(self.path) as entries:
+            files = [(entry.stat().st_mtime, entry) for entry in entries
+                     if entry.name.endswith(".jpg") and entry.is_file()]
+        for _, entry in sorted(files, key=lambda f: f[0]):
+            img_id = int(entry.name[:-len(".jpg")])
+            self._entries[img_id] = entry.stat().st_size
+            self._size += self._entries[img_id]
+
+        self._thread = threading.Thread(target=self._run,
+                                        name="ThumbnailCache", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def add(self, filename: str):
+        # Generates the thumbnail of a new image in the background
+        self._queue.put(filename)
+
+    def get(self, img_id: int):
+        # Returns the JPEG data of the thumbnail, generating it if needed,
+        # or None if there is no such image
+        with self._lock:
+            cached = img_id in self._entries
+            if cached:
+                self._entries.move_to_end(img_id)
+        if cached:
+            filename = self._filename(img_id)
+            try:
+                # The modification time keeps the order between runs
+                os.utime(filename)
+                with open(filename, "rb") as f:
+                    return f.read()
+            except OSError:
+                self._forget(img_id)
+
+        filename = self.storage.find(img_id)
+        if filename is None:
+            return None
+        return self._generate(img_id, filename)
+
+    def _filename(self, img_id):
+        return os.path.join(self.path, f"{img_id}.jpg")
+
+    def _forget(self, img_id):
+        with self._lock:
+            self._size -= self._entries.pop(img_id, 0)
+
+    def _generate(self, img_id, filename):
+        # The catalog thumbnail has the right size already, only decode the
+        # image when there is none
+        data = self.storage.catalog.thumbnail(img_id)
+        if data is None:
+            image = cv2.imread(filename, cv2.IMREAD_REDUCED_COLOR_8)
+            if image is None:
+                return None
+            data = make_thumbnail(image, THUMBNAIL_WIDTH)
+
+        temporary = self._filename(img_id) + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self._filename(img_id))
+
+        with self._lock:
+            self._size += len(data) - self._entries.pop(img_id, 0)
+            self._entries[img_id] = len(data)
+        self._evict()
+        return data
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.budget or len(self._entries) <= 1:
+                    return
+                img_id, size = self._entries.popitem(last=False)
+                self._size -= size
+            try:
+                os.remove(self._filename(img_id))
+            except OSError:
+                pass
+
+    def _run(self):
+        logger = logging.getLogger(__name__)
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                return
+            try:
+                img_id = self.storage.get_id(filename)
+                self._generate(img_id, filename)
+                logger.debug("Thumbnail generated for %s", filename)
+            except Exception:
+                logger.exception("Could not generate thumbnail for %s",
+                                 filename)
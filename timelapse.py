@@ -0,0 +1,50 @@
+import logging
+import math
+import threading
+import time
+
+
+class Timelapse:
+    # Calls capture(index) every interval seconds until count pictures are
+    # taken, or forever if count is None.
+    #
+    # Shots are scheduled from the start time on a monotonic clock, so the
+    # time each capture takes does not make the intervals drift. If a capture
+    # takes longer than the interval, the missed slots are skipped.
+    def __init__(self, capture, interval: float, count: int = None):
+        if interval <= 0:
+            raise ValueError(f"Invalid timelapse interval {interval}")
+        self._capture = capture
+        self.interval = interval
+        self.count = count
+        self.taken = 0
+        self._stop = threading.Event()
+
+    def run(self):
+        logger = logging.getLogger(__name__)
+        logger.info("Start timelapse of %s pictures every %s seconds",
+                    self.count, self.interval)
+        start = time.monotonic()
+        slot = 0
+        while self.count is None or self.taken < self.count:
+            deadline = start + slot * self.interval
+            # Sleeps until the deadline, waking up early only to stop
+            if self._stop.wait(max(deadline - time.monotonic(), 0)):
+                break
+
+            self._capture(self.taken)
+            self.taken += 1
+
+            next_slot = math.ceil((time.monotonic() - start) / self.interval)
+            if next_slot > slot + 1:
+                logger.warning("Timelapse capture took too long, skipping %d"
+                               " shots", next_slot - slot - 1)
+            slot = max(slot + 1, next_slot)
+
+        logger.info("Timelapse finished after %d pictures", self.taken)
+
+    def stop(self):
+        self._stop.set()
+
+    def is_stopped(self) -> bool:
+        return self._stop.is_set()
@@ -1,9 +1,13 @@
+import collections
+import contextlib
+from fractions import Fraction
+import os
 import os.path
-import shutil
+import threading
 import time
-from fractions import Fraction
 
 import cv2
+import numpy as np
 
 
 
@@ -11,48 +15,510 @@ BASE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 FAKE_IMAGE = os.path.join(BASE_DIRECTORY, "potato.jpg")
 
 
-class FakePicamera:
-    class FakeFrame:
-        def __init__(self, frame):
-            self.array = frame
+# Frames that fit in this many bytes are decoded once and kept in memory,
+# bigger sources are decoded on the fly
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Source used by FakePicamera, see source_from_spec for the format
+FAKE_SOURCE_ENV = "PICAM_FAKE_SOURCE"
+# Automatic exposure of the fake camera, at which the source is shown as is
+FAKE_METERED_EXPOSURE = 33333
+
+
+class FrameSource:
+    # Produces the BGR frames of the fake camera. Returned frames are only
+    # valid until the next call to next_frame.
+    resolution = None
+
+    def next_frame(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ImageSource(FrameSource):
+    def __init__(self, filename):
+        self._image = cv2.imread(filename)
+        if self._image is None:
+            raise ValueError(f"Could not read image {filename}")
+        height, width = self._image.shape[:2]
+        self.resolution = (width, height)
+
+    def next_frame(self):
+        return self._image
+
+
+class ImageSequenceSource(FrameSource):
+    def __init__(self, directory, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self._files = sorted(
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if cv2.haveImageReader(os.path.join(directory, f))
+        )
+        if not self._files:
+            raise ValueError(f"No images found in {directory}")
+        first = cv2.imread(self._files[0])
+        height, width = first.shape[:2]
+        self.resolution = (width, height)
+        self._index = 0
+
+        if first.nbytes * len(self._files) <= memory_budget:
+            self._frames = [first] + [cv2.imread(f) for f in self._files[1:]]
+        else:
+            self._frames = None
+
+    def next_frame(self):
+        index = self._index
+        self._index = (self._index + 1) % len(self._files)
+        if self._frames is not None:
+            return self._frames[index]
+        return cv2.imread(self._files[index])
+
+
+class VideoSource(FrameSource):
+    def __init__(self, filename, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self._capture = cv2.VideoCapture(filename)
+        if not self._capture.isOpened():
+            raise ValueError(f"Could not open video {filename}")
+        width = int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.resolution = (width, height)
+        self._frame = None
+        self._frames = None
+        self._index = 0
+
+        if 0 < count and width * height * 3 * count <= memory_budget:
+            self._frames = []
+            while True:
+                ok, frame = self._capture.read()
+                if not ok:
+                    break
+                self._frames.append(frame)
+            self._capture.release()
+
+    def next_frame(self):
+        if self._frames is not None:
+            frame = self._frames[self._index]
+            self._index = (self._index + 1) % len(self._frames)
+            return frame
+
+        # Decode into the same buffer every time, rewinding at the end
+        ok, self._frame = self._capture.read(self._frame)
+        if not ok:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, self._frame = self._capture.read(self._frame)
+        return self._frame
+
+    def close(self):
+        self._capture.release()
+
+
+class TestPatternSource(FrameSource):
+    # Colour bars over a gradient, scrolling horizontally
+    def __init__(self, resolution, speed: int = 8):
+        width, height = resolution
+        self.resolution = (width, height)
+        self._speed = speed
+        self._offset = 0
+
+        columns = np.arange(2 * width, dtype=np.uint16)
+        bars = np.array([[255, 255, 255], [0, 255, 255], [255, 255, 0],
+                         [0, 255, 0], [255, 0, 255], [0, 0, 255],
+                         [255, 0, 0], [0, 0, 0]], dtype=np.uint8)
+        bar_width = max(width // len(bars), 1)
+        row = bars[(columns // bar_width) % len(bars)]
+        shade = np.linspace(1, 0.25, height, dtype=np.float32)[:, None, None]
+        # Twice as wide so every scroll position is a contiguous slice
+        self._pattern = (row[None, :, :] * shade).astype(np.uint8)
+        self._frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def next_frame(self):
+        width = self.resolution[0]
+        np.copyto(self._frame,
+                  self._pattern[:, self._offset:self._offset + width])
+        self._offset = (self._offset + self._speed) % width
+        return self._frame
+
+
+class NoiseSource(FrameSource):
+    def __init__(self, resolution):
+        width, height = resolution
+        self.resolution = (width, height)
+        self._frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def next_frame(self):
+        cv2.randu(self._frame, (0, 0, 0), (256, 256, 256))
+        return self._frame
+
+
+def _parse_resolution(text):
+    width, height = text.lower().split("x")
+    return (int(width), int(height))
+
+
+def source_from_spec(spec: str) -> FrameSource:
+    # "image:<file>", "images:<directory>", "video:<file>",
+    # "pattern:<width>x<height>" or "noise:<width>x<height>"
+    kind, _, argument = spec.partition(":")
+    if kind == "image":
+        return ImageSource(argument)
+    elif kind == "images":
+        return ImageSequenceSource(argument)
+    elif kind == "video":
+        return VideoSource(argument)
+    elif kind == "pattern":
+        return TestPatternSource(_parse_resolution(argument))
+    elif kind == "noise":
+        return NoiseSource(_parse_resolution(argument))
+    raise ValueError(f"Invalid frame source {spec}")
+
+
+def raw_resolution(resolution):
+    # The fake camera does not pad its frames like the real one does
+    return resolution
+
+
+class _FrameClock:
+    # Frame deadlines are computed from the previous deadline on a monotonic
+    # clock instead of from the time the frame was produced, so the time
+    # spent generating and consuming frames does not accumulate as drift.
+    def __init__(self):
+        self._deadline = None
+
+    def wait(self, interval: float):
+        now = time.monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        else:
+            self._deadline += interval
+            if self._deadline < now - interval:
+                # Like the real sensor, skip the frames we were too late for
+                # instead of bursting to catch up
+                missed = (now - self._deadline) // interval
+                self._deadline += missed * interval
+
+        delay = self._deadline - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _Recording:
+    def __init__(self, sink):
+        self.sink = sink
+        self.stop = threading.Event()
+        self.thread = None
+
 
-    def __init__(self, resolution, framerate, sensor_mode):
+class _JpegSink:
+    def __init__(self, output, quality):
+        self._output = output
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    def write_frame(self, frame, timestamp):
+        ok, data = cv2.imencode(".jpeg", frame, self._params)
+        self._output.write(data.tobytes())
+
+    def close(self):
+        pass
+
+
+# Codecs tried in order, OpenCV is often built without an H.264 encoder.
+# The container is chosen by OpenCV from the file extension.
+VIDEO_CODECS = ["avc1", "mp4v"]
+# (extension, codec) written to a temporary file and renamed to the asked
+# name when OpenCV can not write that name directly, e.g. a raw .h264
+# stream. The content differs from the camera's but players detect it.
+FALLBACK_VIDEO_FORMATS = [(".mp4", "mp4v"), (".avi", "MJPG")]
+
+
+class _VideoSink:
+    def __init__(self, filename, resolution, framerate, hold=False):
+        self.resolution = resolution
+        self._filename = filename
+        self._temporary = None
+        attempts = [(filename, codec) for codec in VIDEO_CODECS]
+        attempts += [(filename + extension, codec)
+                     for extension, codec in FALLBACK_VIDEO_FORMATS]
+        for path, codec in attempts:
+            self._writer = cv2.VideoWriter(
+                path, cv2.VideoWriter_fourcc(*codec), float(framerate),
+                tuple(resolution))
+            if self._writer.isOpened():
+                break
+        else:
+            raise ValueError(f"No video encoder can write {filename}")
+        if path != filename:
+            self._temporary = path
+        self._lock = threading.Lock()
+        self._held = [] if hold else None
+
+    def write_frame(self, frame, timestamp):
+        with self._lock:
+            if self._held is not None:
+                self._held.append(frame.copy())
+            else:
+                self._writer.write(frame)
+
+    def write_first(self, frames):
+        # Writes frames before the held ones and stops holding
+        with self._lock:
+            for frame in frames:
+                self._writer.write(frame)
+            for frame in self._held or []:
+                self._writer.write(frame)
+            self._held = None
+
+    def close(self):
+        with self._lock:
+            self._writer.release()
+            if self._temporary is not None:
+                os.replace(self._temporary, self._filename)
+
+
+class FakeCircularIO:
+    # Stand-in for picamera's PiCameraCircularIO keeping the last seconds of
+    # a recording. Frames are kept JPEG-compressed to bound its memory.
+    def __init__(self, camera, seconds, bitrate=17000000, splitter_port=1):
+        self.camera = camera
+        self.seconds = seconds
+        self.splitter_port = splitter_port
+        self.resolution = None
+        self._frames = collections.deque()
+        self._lock = threading.Lock()
+
+    def write_frame(self, frame, timestamp):
+        ok, data = cv2.imencode(".jpeg", frame)
+        with self._lock:
+            self._frames.append((timestamp, data))
+            while self._frames[0][0] < timestamp - self.seconds:
+                self._frames.popleft()
+
+    def copy_to(self, output, seconds=None):
+        # The fake encodes frames, not a byte stream, so they go to the
+        # video the recording was split to rather than to output
+        with self._lock:
+            frames = list(self._frames)
+        if seconds is not None and frames:
+            frames = [f for f in frames if f[0] >= frames[-1][0] - seconds]
+        sink = self.camera._recordings[self.splitter_port].sink
+        sink.write_first(cv2.imdecode(data, cv2.IMREAD_COLOR)
+                         for _, data in frames)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+    def close(self):
+        pass
+
+
+class FakePicamera:
+    def __init__(self, resolution, framerate, sensor_mode, source=None):
+        if source is None:
+            spec = os.environ.get(FAKE_SOURCE_ENV)
+            source = source_from_spec(spec) if spec else ImageSource(FAKE_IMAGE)
+        self._source = source
+        if resolution is None:
+            resolution = source.resolution
         self.resolution = resolution
         self.framerate = framerate
         self.sensor_mode = sensor_mode
 
         self.awb_mode = None
+        self.awb_gains = (1.0, 1.0)
         self.iso = None
         self.brightness = None
         self.contrast = None
         self.exposure_mode = None
-        self.shutter_speed = Fraction(1, 1000)
+        self.shutter_speed = 0  # auto, in microseconds like picamera
         self.led = None
 
+        # Sources are not thread safe and recordings render from their own
+        # threads
+        self._render_lock = threading.Lock()
+        self._recordings = {}
+        # Splitter ports used by captures from the video port. Like on the
+        # real camera, a port does one thing at a time.
+        self._video_ports = set()
+
+    @property
+    def framerate(self):
+        return self._framerate
+
+    @framerate.setter
+    def framerate(self, value):
+        # Like picamera, which can not reconfigure a running encoder
+        if getattr(self, "_recordings", None):
+            raise RuntimeError("Can not change the framerate while recording")
+        self._framerate = value
+
     @property
     def exposure_speed(self):
-        return self.shutter_speed
+        if self.shutter_speed:
+            return self.shutter_speed
+        # Automatic exposure, shorter at a higher ISO
+        return min(FAKE_METERED_EXPOSURE * 100 // (self.iso or 100),
+                   int(1000000 / self.framerate))
+
+    @property
+    def analog_gain(self):
+        return Fraction(self.iso or 100, 100)
+
+    @property
+    def digital_gain(self):
+        return Fraction(1)
+
+    def _frame_interval(self) -> float:
+        # A frame can not be shorter than its exposure
+        return max(1 / float(self.framerate), self.shutter_speed / 1000000)
 
     def close(self):
-        pass
+        for splitter_port in list(self._recordings):
+            self.stop_recording(splitter_port)
+        self._source.close()
 
-    def capture(self, filename):
-        shutil.copy(FAKE_IMAGE, filename)
+    def _render(self, frame, format):
+        # Fill frame with the next frame of the source
+        with self._render_lock:
+            source_frame = self._source.next_frame()
+            if source_frame.shape == frame.shape:
+                np.copyto(frame, source_frame)
+            else:
+                cv2.resize(source_frame, frame.shape[1::-1], dst=frame,
+                           interpolation=cv2.INTER_AREA)
+        if self.shutter_speed:
+            # Manual exposure, brighter or darker than the metered one
+            gain = (self.shutter_speed * (self.iso or 100)
+                    / (FAKE_METERED_EXPOSURE * 100))
+            if gain != 1:
+                cv2.convertScaleAbs(frame, dst=frame, alpha=gain)
+        if format == "rgb":
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        return frame
 
-    def capture_continuous(self, raw_capture, format, use_video_port):
-        while True:
-            frame = cv2.imread(FAKE_IMAGE)
+    def _encode(self, frame, image_format):
+        if image_format in ("rgb", "bgr"):
+            return self._render(frame, image_format)
+        elif image_format == "rgba":
+            return cv2.cvtColor(self._render(frame, "bgr"), cv2.COLOR_BGR2RGBA)
+        elif image_format == "yuv":
+            return cv2.cvtColor(self._render(frame, "bgr"),
+                                cv2.COLOR_BGR2YUV_I420)
+        ok, data = cv2.imencode("." + image_format, self._render(frame, "bgr"))
+        if not ok:
+            raise ValueError(f"Invalid format {image_format}")
+        return data
 
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            cv2.putText(frame, f"{time.time()}",
-                        (100, 100), font, 3, (0, 255, 0), 2, cv2.LINE_AA)
-            yield self.FakeFrame(frame)
+    def _save(self, output, frame, image_format):
+        if isinstance(output, str):
+            if image_format is None:
+                image_format = os.path.splitext(output)[1][1:]
+            with open(output, "wb") as f:
+                f.write(self._encode(frame, image_format))
+        else:
+            output.write(self._encode(frame, image_format))
 
+    def capture(self, output, format=None, use_video_port=False):
+        time.sleep(self.exposure_speed / 1000000)
+        width, height = self.resolution
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        self._save(output, frame, format)
 
+    @contextlib.contextmanager
+    def _video_port(self, use_video_port, splitter_port):
+        if not use_video_port:
+            yield
+            return
+        if (splitter_port in self._video_ports
+                or splitter_port in self._recordings):
+            raise RuntimeError(f"Port {splitter_port} is already in use")
+        self._video_ports.add(splitter_port)
+        try:
+            yield
+        finally:
+            self._video_ports.discard(splitter_port)
 
-class FakePiRGBArray:
-    def __init__(self, camera):
-        pass
+    def capture_sequence(self, outputs, format="jpeg", use_video_port=False,
+                         splitter_port=0):
+        width, height = self.resolution
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        clock = _FrameClock()
+        with self._video_port(use_video_port, splitter_port):
+            for output in outputs:
+                if use_video_port:
+                    clock.wait(self._frame_interval())
+                else:
+                    time.sleep(self.exposure_speed / 1000000)
+                self._save(output, frame, format)
 
-    def truncate(self, size):
-        pass
+    def capture_continuous(self, output, format, use_video_port,
+                           resize=None, splitter_port=0):
+        width, height = resize or self.resolution
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        clock = _FrameClock()
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        with self._video_port(use_video_port, splitter_port):
+            while True:
+                # framerate and shutter_speed may change while capturing
+                clock.wait(self._frame_interval())
+
+                self._render(frame, format)
+                cv2.putText(frame, f"{time.time()}",
+                            (100, 100), font, 3, (0, 255, 0), 2, cv2.LINE_AA)
+                output.write(frame)
+                output.flush()
+                yield output
+
+    def start_recording(self, output, format="h264", splitter_port=1,
+                        resize=None, quality=0, bitrate=17000000):
+        if (splitter_port in self._recordings
+                or splitter_port in self._video_ports):
+            raise RuntimeError(f"Port {splitter_port} is already in use")
+        resolution = resize or self.resolution
+        if format == "mjpeg":
+            sink = _JpegSink(output, quality or 85)
+        elif format == "h264":
+            sink = self._video_sink(output, resolution)
+        else:
+            raise ValueError(f"Invalid format {format}")
+        recording = _Recording(sink)
+        recording.thread = threading.Thread(
+            target=self._record, args=(recording, resolution),
+            name=f"FakeEncoder{splitter_port}", daemon=True)
+        self._recordings[splitter_port] = recording
+        recording.thread.start()
+
+    def split_recording(self, output, splitter_port=1):
+        recording = self._recordings[splitter_port]
+        old_sink = recording.sink
+        # After a circular buffer, frames wait for its copy_to so the file
+        # starts with the buffered ones
+        sink = self._video_sink(output, old_sink.resolution,
+                                hold=isinstance(old_sink, FakeCircularIO))
+        recording.sink = sink
+        old_sink.close()
+
+    def stop_recording(self, splitter_port=1):
+        recording = self._recordings.pop(splitter_port)
+        recording.stop.set()
+        recording.thread.join()
+        recording.sink.close()
+
+    def _video_sink(self, output, resolution, hold=False):
+        if isinstance(output, FakeCircularIO):
+            output.resolution = resolution
+            return output
+        filename = output if isinstance(output, str) else output.name
+        return _VideoSink(filename, resolution, self.framerate, hold)
+
+    def _record(self, recording, resolution):
+        width, height = resolution
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        clock = _FrameClock()
+        while not recording.stop.is_set():
+            clock.wait(self._frame_interval())
+            self._render(frame, "bgr")
+            cv2.putText(frame, f"{time.time():.2f}", (10, height - 10),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2,
+                        cv2.LINE_AA)
+            recording.sink.write_frame(frame, time.monotonic())
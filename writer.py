@@ -0,0 +1,121 @@
+import logging
+import os
+import os.path
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+
+DEFAULT_MAX_QUEUED = 8
+
+# What write() does when max_queued images are already waiting in memory
+OVERFLOW_BLOCK = "block"  # wait for the writer to catch up
+OVERFLOW_SPILL = "spill"  # write the data to a temporary file right away
+
+
+def _temporary_name(filename):
+    # Hidden, so it is never mistaken for a finished image
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, f".{name}.part")
+
+
+class ImageWriter:
+    # Writes images to disk on a background thread, so the thread that
+    # captures them does not wait for the storage.
+    #
+    # Images are written to a temporary file that is renamed once complete,
+    # so a finished name never refers to a partial image. Data can be encoded
+    # bytes or a BGR array, which is encoded according to the file extension.
+    def __init__(self, max_queued: int = DEFAULT_MAX_QUEUED,
+                 fsync: bool = False, overflow: str = OVERFLOW_SPILL,
+                 on_written=None):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_SPILL):
+            raise ValueError(f"Invalid overflow policy {overflow}")
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_queued)
+        self._fsync = fsync
+        self._overflow = overflow
+        # Called with the filename on the writer thread once it is complete
+        self._on_written = on_written
+        self._thread = None
+        self.spilled = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ImageWriter",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Queued images are written before stopping
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def write(self, filename: str, data):
+        if self._slots.acquire(blocking=False):
+            self._queue.put((filename, data, False))
+        elif self._overflow == OVERFLOW_BLOCK:
+            self._slots.acquire()
+            self._queue.put((filename, data, False))
+        else:
+            # Keep the memory bounded: write the data now, only the rename
+            # (and fsync) is left to the writer
+            logging.getLogger(__name__).warning("Writer queue full, spilling"
+                                                " %s to disk", filename)
+            self._write_file(filename, data)
+            self.spilled += 1
+            self._queue.put((filename, None, True))
+
+    def flush(self):
+        # Wait until every queued image is written
+        self._queue.join()
+
+    def _write_file(self, filename, data):
+        # filename is the final name, the data goes to its temporary file
+        if isinstance(data, np.ndarray):
+            ok, data = cv2.imencode(os.path.splitext(filename)[1], data)
+            if not ok:
+                raise ValueError(f"Could not encode {filename}")
+        with open(_temporary_name(filename), "wb") as f:
+            f.write(data)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _fsync_directory(directory):
+        # Makes the rename itself durable
+        fd = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        logger = logging.getLogger(__name__)
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                filename, data, spilled = item
+                if not spilled:
+                    try:
+                        self._write_file(filename, data)
+                    finally:
+                        self._slots.release()
+                elif self._fsync:
+                    with open(_temporary_name(filename), "rb+") as f:
+                        os.fsync(f.fileno())
+                os.replace(_temporary_name(filename), filename)
+                if self._fsync:
+                    self._fsync_directory(os.path.dirname(filename))
+                logger.info("Image saved at %s", filename)
+                if self._on_written is not None:
+                    self._on_written(filename)
+            except Exception:
+                logger.exception("Could not write image")
+            finally:
+                self._queue.task_done()